@@ -45,6 +45,9 @@ from .nodes.Setter import NODE_DISPLAY_NAME_MAPPINGS as SETTERSTATE_DISPLAY
 from .nodes.Getter import NODE_CLASS_MAPPINGS as GETTERSTATE_MAPPINGS
 from .nodes.Getter import NODE_DISPLAY_NAME_MAPPINGS as GETTERSTATE_DISPLAY
 
+from .nodes.VarSnapshot import NODE_CLASS_MAPPINGS as VARSNAP_STATE_MAPPINGS
+from .nodes.VarSnapshot import NODE_DISPLAY_NAME_MAPPINGS as VARSNAP_STATE_DISPLAY
+
 from .nodes.AKResizeOnBoolean import NODE_CLASS_MAPPINGS as RESIZESTATE_MAPPINGS
 from .nodes.AKResizeOnBoolean import NODE_DISPLAY_NAME_MAPPINGS as RESIZESTATE_DISPLAY
 
@@ -70,6 +73,7 @@ NODE_CLASS_MAPPINGS = {
     **AKPIPEL_STATE_MAPPINGS,
     **SETTERSTATE_MAPPINGS,
     **GETTERSTATE_MAPPINGS,
+    **VARSNAP_STATE_MAPPINGS,
     **RESIZESTATE_MAPPINGS,
     **ISMSTATE_MAPPINGS,
     **AKSAT_STATE_MAPPINGS,
@@ -91,6 +95,7 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     **AKPIPEL_STATE_DISPLAY,
     **SETTERSTATE_DISPLAY,
     **GETTERSTATE_DISPLAY,
+    **VARSNAP_STATE_DISPLAY,
     **RESIZESTATE_DISPLAY,
     **ISMSTATE_DISPLAY,
     **AKSAT_STATE_DISPLAY,
@@ -0,0 +1,417 @@
+"""Headless CPU benchmark for AK Pipe, AK Pipe Loop, Setter and Getter.
+
+Runs the node classes directly (no ComfyUI server) against synthetic
+model / CLIP / VAE / conditioning / latent / image payloads and reports,
+per chain length:
+
+  - median latency per hop (one node execution) in microseconds
+  - Python memory still held per hop after a run (tracemalloc: blocks and
+    bytes retained; memory freed before the run ends is not included)
+  - peak extra Python memory during one run (transient allocations)
+
+Usage (from the repository root):
+
+  python benchmarks/bench_pipe_vars.py
+  python benchmarks/bench_pipe_vars.py --lengths 10 100 1000 --json bench.json
+  python benchmarks/bench_pipe_vars.py --baseline bench.json --tolerance 0.25
+
+With --baseline the run exits with status 1 when a latency is more than
+`tolerance` slower than the baseline.
+
+Payloads are created and every scenario runs under torch.inference_mode(),
+as in ComfyUI's executor.
+"""
+
+import argparse
+import atexit
+import gc
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PKG = "ak_pack_nodes"
+
+
+# ---------------------------------------------------------------------------
+# Stub ComfyUI modules (comfy, folder_paths, server, nodes), so the nodes
+# import without a ComfyUI checkout.
+# ---------------------------------------------------------------------------
+
+def _install_stubs():
+    if "comfy" not in sys.modules:
+        comfy = types.ModuleType("comfy")
+        comfy.__path__ = []
+        utils = types.ModuleType("comfy.utils")
+        utils.ProgressBar = lambda total: types.SimpleNamespace(update=lambda n: None)
+        samplers = types.ModuleType("comfy.samplers")
+        samplers.KSampler = types.SimpleNamespace(SAMPLERS=["euler"], SCHEDULERS=["normal"])
+        mm = types.ModuleType("comfy.model_management")
+        mm.get_torch_device = lambda: "cpu"
+        comfy.utils, comfy.samplers, comfy.model_management = utils, samplers, mm
+        sys.modules.update({
+            "comfy": comfy,
+            "comfy.utils": utils,
+            "comfy.samplers": samplers,
+            "comfy.model_management": mm,
+        })
+    if "folder_paths" not in sys.modules:
+        fp = types.ModuleType("folder_paths")
+        tmp = tempfile.mkdtemp(prefix="ak_bench_")
+        atexit.register(shutil.rmtree, tmp, True)
+        fp.get_user_directory = lambda: tmp
+        fp.get_output_directory = lambda: tmp
+        fp.get_temp_directory = lambda: tmp
+        sys.modules["folder_paths"] = fp
+    if "server" not in sys.modules:
+        class _Routes:
+            def _route(self, path):
+                return lambda fn: fn
+            get = post = _route
+
+        instance = types.SimpleNamespace(
+            routes=_Routes(),
+            last_prompt_id=None,
+            on_prompt_handlers=[],
+        )
+        instance.add_on_prompt_handler = instance.on_prompt_handlers.append
+        server = types.ModuleType("server")
+        server.PromptServer = types.SimpleNamespace(instance=instance)
+        sys.modules["server"] = server
+    if "nodes" not in sys.modules:
+        # ComfyUI's node registry; the Getter/Setter rewrite reads types from it.
+        class Source:
+            RETURN_TYPES = ("LATENT",)
+
+        class Consumer:
+            @classmethod
+            def INPUT_TYPES(cls):
+                return {"required": {"value": ("LATENT",)}}
+
+        registry = types.ModuleType("nodes")
+        registry.NODE_CLASS_MAPPINGS = {"Source": Source, "Consumer": Consumer}
+        sys.modules["nodes"] = registry
+
+
+def _load_nodes():
+    """Import nodes/ as a private package (avoids clashing with ComfyUI's `nodes`)."""
+    if PKG not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            PKG, os.path.join(ROOT, "nodes", "__init__.py"),
+            submodule_search_locations=[os.path.join(ROOT, "nodes")],
+        )
+        pkg = importlib.util.module_from_spec(spec)
+        sys.modules[PKG] = pkg
+    mods = {}
+    for name in ("AKPipe", "AKPipeLoop", "Setter", "Getter", "VarCollapse"):
+        mods[name] = importlib.import_module(f"{PKG}.{name}")
+    for name in ("Setter", "Getter"):
+        sys.modules["nodes"].NODE_CLASS_MAPPINGS.setdefault(name, getattr(mods[name], name))
+    return mods
+
+
+# ---------------------------------------------------------------------------
+# Synthetic payloads (SDXL-sized, fp16 where ComfyUI would use it).
+# ---------------------------------------------------------------------------
+
+class FakeModel:
+    """Stands in for ModelPatcher / CLIP / VAE: a few weight tensors plus patches_uuid."""
+
+    def __init__(self, name, shapes, dtype):
+        import torch
+        import uuid
+        self.name = name
+        self.weights = {f"w{i}": torch.zeros(s, dtype=dtype) for i, s in enumerate(shapes)}
+        self.patches = {}
+        self.patches_uuid = uuid.uuid4()
+
+
+def make_payloads():
+    import torch
+    h = torch.float16
+    return {
+        "model": FakeModel("unet", [(1280, 1280)] * 8, h),
+        "clip": FakeModel("clip", [(1280, 1280)] * 4, h),
+        "vae": FakeModel("vae", [(512, 512)] * 4, h),
+        "positive": [[torch.randn(1, 154, 2048).half(), {"pooled_output": torch.randn(1, 1280).half()}]],
+        "negative": [[torch.randn(1, 77, 2048).half(), {"pooled_output": torch.randn(1, 1280).half()}]],
+        "latent": {"samples": torch.randn(1, 4, 128, 128)},
+        "image": torch.rand(1, 1024, 1024, 3),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Scenarios. Each returns a callable running one full chain, its hop count
+# and an optional untimed setup whose result is passed to the callable.
+# ---------------------------------------------------------------------------
+
+def scenario_pipe_chain(mods, payloads, length):
+    """AK Pipe -> AK Pipe -> ... ; the head sets everything, every 4th hop replaces the latent."""
+    AKPipe = mods["AKPipe"].AKPipe
+    nodes = [AKPipe() for _ in range(length)]
+    head = {k: payloads[k] for k in ("model", "clip", "vae", "positive", "negative", "latent", "image")}
+    alt_latent = {"samples": payloads["latent"]["samples"].clone()}
+
+    def run():
+        pipe = nodes[0].run(**head)[0]
+        for i, node in enumerate(nodes[1:], 1):
+            if i % 4 == 0:
+                pipe = node.run(pipe_in=pipe, latent=alt_latent)[0]
+            else:
+                pipe = node.run(pipe_in=pipe)[0]
+        return pipe
+
+    return run, length, None
+
+
+def scenario_pipe_loop(mods, payloads, length):
+    """`length` AK Pipe Loop nodes, each with 10 connected pipes, all unchanged between runs.
+
+    Each node is driven like ComfyUI's executor drives a lazy node:
+    check_lazy_status() until it asks for nothing more, then run().
+    """
+    AKPipe = mods["AKPipe"].AKPipe
+    AKPipeLoop = mods["AKPipeLoop"].AKPipeLoop
+    pipes = []
+    pipe = AKPipe().run(**{k: payloads[k] for k in ("model", "clip", "vae", "positive", "negative")})[0]
+    for i in range(10):
+        pipe = AKPipe().run(pipe_in=pipe, latent={"samples": payloads["latent"]["samples"]})[0]
+        pipes.append(pipe)
+    loops = [AKPipeLoop() for _ in range(length)]
+    prompt = {str(i): {"inputs": {f"pipe_in_{j + 1}": ["p", j] for j in range(10)}} for i in range(length)}
+
+    names = AKPipeLoop.INPUT_NAMES
+
+    def run():
+        out = None
+        for i, loop in enumerate(loops):
+            uid = str(i)
+            kwargs = {"pipe_in_1": pipes[0]}
+            kwargs.update((name, None) for name in names[1:])
+            while True:
+                need = [n for n in loop.check_lazy_status(unique_id=uid, prompt=prompt, **kwargs) if kwargs[n] is None]
+                if not need:
+                    break
+                for n in need:
+                    kwargs[n] = pipes[names.index(n)]
+            out = loop.run(unique_id=uid, prompt=prompt, **kwargs)
+        return out
+
+    run()  # first run marks every input as changed; measure steady state
+    return run, length, None
+
+
+def _vars_prompt(length):
+    """Source -> Setter -> Getter -> consumer, `length` times."""
+    prompt = {}
+    for i in range(length):
+        prompt[f"x{i}"] = {"class_type": "Source", "inputs": {"seed": i}}
+        prompt[f"s{i}"] = {"class_type": "Setter", "inputs": {"obj": [f"x{i}", 0], "var_name": f"var_{i:04d}"}}
+        prompt[f"g{i}"] = {"class_type": "Getter", "inputs": {"inp": [f"s{i}", 0]}}
+        prompt[f"c{i}"] = {"class_type": "Consumer", "inputs": {"value": [f"g{i}", 0]}}
+    return prompt
+
+
+def scenario_vars(mods, payloads, length):
+    """`length` Setter/Getter pairs in the default mode: the prompt handler
+    scopes each queued prompt and collapses Getter/Setter, so the nodes
+    themselves never run. A fresh prompt (untimed) per run."""
+    on_prompt = mods["VarCollapse"].on_prompt
+    prompt = _vars_prompt(length)
+    counter = [0]
+
+    def setup():
+        counter[0] += 1
+        return {
+            "prompt_id": f"bench-{counter[0]}",
+            "prompt": {k: {"class_type": v["class_type"], "inputs": dict(v["inputs"])} for k, v in prompt.items()},
+        }
+
+    def run(json_data):
+        out = on_prompt(json_data)
+        assert "s0" not in out["prompt"], "Getter/Setter collapse did not run"
+        return out
+
+    return run, 2 * length, setup
+
+
+def scenario_vars_eager(mods, payloads, length):
+    """`length` Setter/Getter pairs executed as nodes (AK_VAR_COLLAPSE=0); a new
+    prompt (and prompt_id) per run, like a queued workflow."""
+    Setter = mods["Setter"].Setter
+    Getter = mods["Getter"].Getter
+    setters = [Setter() for _ in range(length)]
+    getters = [Getter() for _ in range(length)]
+    values = [payloads["latent"], payloads["image"], payloads["positive"], payloads["model"]]
+
+    prompt = {}
+    for i in range(length):
+        prompt[f"s{i}"] = {"class_type": "Setter", "inputs": {"obj": ["x", 0], "var_name": f"var_{i:04d}"}}
+        prompt[f"g{i}"] = {"class_type": "Getter", "inputs": {"inp": [f"s{i}", 0]}}
+
+    server = sys.modules["server"].PromptServer.instance
+    counter = [0]
+
+    def run():
+        counter[0] += 1
+        server.last_prompt_id = f"bench-{counter[0]}"
+        p = dict(prompt)
+        out = None
+        for i in range(length):
+            v = setters[i].set(values[i % len(values)], f"var_{i:04d}", prompt=p, unique_id=f"s{i}")[0]
+            out = getters[i].get(inp=v, var_name=f"var_{i:04d}", unique_id=f"g{i}")
+        return out
+
+    return run, 2 * length, None
+
+
+SCENARIOS = {
+    "pipe_chain": scenario_pipe_chain,
+    "pipe_loop": scenario_pipe_loop,
+    "vars": scenario_vars,
+    "vars_eager": scenario_vars_eager,
+}
+
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+
+def measure(run, hops, repeat, min_time, setup=None):
+    run() if setup is None else run(setup())  # warm-up
+    samples = []
+    deadline = time.perf_counter() + min_time
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        while len(samples) < repeat or time.perf_counter() < deadline:
+            arg = setup() if setup is not None else None
+            t0 = time.perf_counter_ns()
+            if setup is None:
+                run()
+            else:
+                run(arg)
+            samples.append((time.perf_counter_ns() - t0) / hops)
+            if len(samples) >= repeat * 20:
+                break
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    arg = setup() if setup is not None else None
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        if setup is None:
+            run()
+        else:
+            run(arg)
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    # Snapshot diffs only see what is still allocated after the run, so these
+    # are retained blocks/bytes; transient allocations show up in the peak.
+    # The `before` snapshot itself is allocated by tracemalloc and left out.
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    stats = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), "filename")
+    blocks = sum(max(s.count_diff, 0) for s in stats)
+    size = sum(max(s.size_diff, 0) for s in stats)
+
+    return {
+        "hops": hops,
+        "runs": len(samples),
+        "median_us_per_hop": round(statistics.median(samples) / 1000.0, 3),
+        "p90_us_per_hop": round(sorted(samples)[int(len(samples) * 0.9) - 1] / 1000.0, 3),
+        "retained_blocks_per_hop": round(blocks / hops, 2),
+        "retained_bytes_per_hop": round(size / hops, 1),
+        "peak_traced_kb": round((peak - start) / 1024.0, 1),
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    base = baseline.get("results", {})
+    for name, by_len in results.items():
+        for length, res in by_len.items():
+            ref = base.get(name, {}).get(length)
+            if not ref:
+                continue
+            old, new = ref["median_us_per_hop"], res["median_us_per_hop"]
+            res["baseline_us_per_hop"] = old
+            if old > 0 and new > old * (1.0 + tolerance):
+                regressions.append(f"{name}[{length}]: {old:.3f} -> {new:.3f} us/hop")
+    return regressions
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--lengths", type=int, nargs="+", default=[10, 100, 1000])
+    ap.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    ap.add_argument("--repeat", type=int, default=20, help="minimum timed runs per case")
+    ap.add_argument("--min-time", type=float, default=0.5, help="minimum seconds per case")
+    ap.add_argument("--json", dest="json_out", help="write results to this file")
+    ap.add_argument("--baseline", help="compare against a previous --json file")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown vs baseline (0.25 = 25%%)")
+    args = ap.parse_args(argv)
+
+    import torch
+    torch.set_num_threads(1)
+
+    _install_stubs()
+    mods = _load_nodes()
+
+    results = {}
+    print(f"{'scenario':<12} {'length':>6} {'us/hop':>10} {'p90':>10} {'ret blk/hop':>11} {'ret B/hop':>11} {'peak KB':>9}")
+    # ComfyUI executes nodes under inference mode; so does the benchmark.
+    with torch.inference_mode():
+        payloads = make_payloads()
+        for name in args.scenarios:
+            results[name] = {}
+            for length in args.lengths:
+                run, hops, setup = SCENARIOS[name](mods, payloads, length)
+                res = measure(run, hops, args.repeat, args.min_time, setup)
+                results[name][str(length)] = res
+                print(
+                    f"{name:<12} {length:>6} {res['median_us_per_hop']:>10.3f} {res['p90_us_per_hop']:>10.3f} "
+                    f"{res['retained_blocks_per_hop']:>11.2f} {res['retained_bytes_per_hop']:>11.1f} {res['peak_traced_kb']:>9.1f}"
+                )
+
+    report = {
+        "python": sys.version.split()[0],
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions (> {:.0%} slower than baseline):".format(args.tolerance))
+            for line in regressions:
+                print("  " + line)
+            status = 1
+        else:
+            print("\nNo regressions against baseline.")
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
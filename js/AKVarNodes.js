@@ -90,8 +90,27 @@ function collectSetterNames(graph) {
   return uniq;
 }
 
+// Bumped whenever a Setter is added, removed or renamed. Setter names are only
+// collected again (and Getter combos only refreshed) when it changes.
+let _akNamesVersion = 0;
+let _akNamesCache = { version: -1, graph: null, names: [] };
+
+function bumpSetterNames() {
+  _akNamesVersion++;
+}
+
+function getSetterNames(graph) {
+  const c = _akNamesCache;
+  if (c.version === _akNamesVersion && c.graph === graph) return c.names;
+  const names = collectSetterNames(graph);
+  _akNamesCache = { version: _akNamesVersion, graph, names };
+  return names;
+}
+
 let _lastKey = "";
 let _lastNames = [];
+let _lastVersion = -1;
+let _lastGraph = null;
 
 let _akUpdateCombosTimer = null;
 let _akUpdateCombosForce = false;
@@ -296,7 +315,11 @@ function applyNamesToNode(node, names) {
 
 function updateCombos(graph, force = false) {
   _akCount("updateCombos", 200);
-  const names = collectSetterNames(graph);
+  if (!force && _akNamesVersion === _lastVersion && graph === _lastGraph) return;
+  _lastVersion = _akNamesVersion;
+  _lastGraph = graph;
+
+  const names = getSetterNames(graph);
   const k = keyOf(names);
   if (!force && k === _lastKey) return;
 
@@ -321,6 +344,17 @@ function hookSetter(node, context = "") {
 
   _disableVarNameInputConnections(node);
 
+  if (!node._akVarRemoveHooked) {
+    node._akVarRemoveHooked = true;
+    const prevRemoved = node.onRemoved;
+    node.onRemoved = function (...args) {
+      const r = prevRemoved ? prevRemoved.apply(this, args) : undefined;
+      bumpSetterNames();
+      try { scheduleUpdateCombos(); } catch (_) { }
+      return r;
+    };
+  }
+
   const w = getWidget(node, "var_name");
   // if (!w || w._akVarHooked) return;
   w._akVarHooked = true;
@@ -344,6 +378,7 @@ function hookSetter(node, context = "") {
       const sid = (typeof node.id === "number" && node.id >= 0) ? node.id : null;
       // const token = (sid != null) ? _setChangedName(ov, nv, sid) : null;
       const token = _setChangedName(ov, nv, node.id);
+      bumpSetterNames();
 
       // try { updateCombos(app.graph, true); } catch (_) { }
 
@@ -688,6 +723,7 @@ app.registerExtension({
     if (!node) return;
 
     if (_isSetterNode(node)) {
+      bumpSetterNames();
       try { hookSetter(node, "nodeCreated"); } catch (_) { }
       try { scheduleUpdateCombos(true); } catch (_) { }
       try { _colorizeSetterGetterNodes(node, "Setter"); } catch (_) { }
@@ -700,7 +736,7 @@ app.registerExtension({
     }
 
     if (_isGetterNode(node)) {
-      const names = collectSetterNames(app.graph);
+      const names = getSetterNames(app.graph);
       ensureVarNameWidget(node, names);
       try { initGetter(node); } catch (_) { }
       try { hookGetter(node, "nodeCreated"); } catch (_) { }
@@ -719,7 +755,8 @@ app.registerExtension({
 
   async afterConfigureGraph() {
     const nodes = app.graph?._nodes || [];
-    const names = collectSetterNames(app.graph);
+    bumpSetterNames();
+    const names = getSetterNames(app.graph);
 
     for (const node of nodes) {
       if (_isSetterNode(node)) {
@@ -1,5 +1,225 @@
 # AKPipe.py (patched with hash support)
 
+import itertools
+import time
+import weakref
+
+from . import AKPipeTrace
+
+
+class AnyType(str):
+    def __ne__(self, __value: object) -> bool:
+        return False
+
+
+ANY_TYPE = AnyType("*")
+
+# Serial numbers for live objects. Unlike id(), a serial is never reused
+# after the object is collected.
+_serials = {}
+_serial_counter = itertools.count(1)
+
+# Containers (LATENT dicts, CONDITIONING lists) are fingerprinted by their
+# first few items only, so a fingerprint stays constant-time.
+_FP_MAX_ITEMS = 32
+_FP_MAX_DEPTH = 3
+
+
+def _object_serial(obj):
+    oid = id(obj)
+    entry = _serials.get(oid)
+    if entry is not None and entry[0]() is obj:
+        return entry[1]
+
+    def _drop(ref, oid=oid):
+        cur = _serials.get(oid)
+        if cur is not None and cur[0] is ref:
+            del _serials[oid]
+
+    try:
+        ref = weakref.ref(obj, _drop)
+    except TypeError:
+        return ("id", oid)
+    serial = next(_serial_counter)
+    _serials[oid] = (ref, serial)
+    return serial
+
+
+def _fingerprint(obj, depth=0):
+    """Constant-time identity/version fingerprint of a pipe value.
+
+    Tensors: object serial, shape, dtype, storage pointer and the in-place
+    _version counter (inference tensors have no version counter, so theirs
+    is left out). Dicts/lists/tuples: fingerprints of their first items.
+    Anything else (models, VAE, CLIP): object serial plus patches_uuid when
+    the object has one.
+    """
+    if obj is None or isinstance(obj, (bool, int, float)):
+        return obj
+    if isinstance(obj, str):
+        return obj if len(obj) <= 256 else ("str", len(obj), hash(obj))
+
+    if hasattr(obj, "data_ptr") and hasattr(obj, "is_inference"):
+        try:
+            # Reading _version of a tensor made under torch.inference_mode()
+            # (how ComfyUI runs nodes) raises RuntimeError.
+            version = None if obj.is_inference() else obj._version
+            return ("T", _object_serial(obj), tuple(obj.shape), str(obj.dtype), obj.data_ptr(), version)
+        except Exception:
+            return ("T", _object_serial(obj))
+
+    if isinstance(obj, (dict, list, tuple)) and depth < _FP_MAX_DEPTH:
+        if isinstance(obj, dict):
+            items = itertools.islice(obj.items(), _FP_MAX_ITEMS)
+            body = tuple((k, _fingerprint(v, depth + 1)) for k, v in items)
+        else:
+            items = itertools.islice(obj, _FP_MAX_ITEMS)
+            body = tuple(_fingerprint(v, depth + 1) for v in items)
+        return (type(obj).__name__, len(obj), body)
+
+    return ("O", type(obj).__name__, _object_serial(obj), getattr(obj, "patches_uuid", None))
+
+
+def _field_hash(obj):
+    """Integer fingerprint of one pipe field (None stays None)."""
+    if obj is None:
+        return None
+    try:
+        return hash(_fingerprint(obj))
+    except TypeError:
+        return hash(("O", _object_serial(obj)))
+
+
+class AKPipeData:
+    """Pipe record passed on AK_PIPE links. Treat as immutable.
+
+    Copy-on-write: updated() returns the same record when nothing changes,
+    otherwise a new record sharing every untouched field. Indexing, len()
+    and iteration behave like the old (hash, model, clip, vae, positive,
+    negative, latent, image) tuple.
+
+    field_hashes holds one fingerprint per field (same order as FIELDS), so
+    consumers can tell which fields changed between two records.
+    """
+
+    __slots__ = ("version", "hash", "model", "clip", "vae", "positive", "negative", "latent", "image", "field_hashes")
+
+    VERSION = 3  # 1 = plain 7/8-tuple pipes, 2 = record without field hashes
+    TUPLE_FIELDS = ("hash", "model", "clip", "vae", "positive", "negative", "latent", "image")
+    FIELDS = TUPLE_FIELDS[1:]
+
+    def __init__(self, hash=None, model=None, clip=None, vae=None, positive=None, negative=None, latent=None, image=None, field_hashes=None):
+        self.version = self.VERSION
+        self.hash = hash
+        self.model = model
+        self.clip = clip
+        self.vae = vae
+        self.positive = positive
+        self.negative = negative
+        self.latent = latent
+        self.image = image
+        if field_hashes is None:
+            field_hashes = (
+                _field_hash(model),
+                _field_hash(clip),
+                _field_hash(vae),
+                _field_hash(positive),
+                _field_hash(negative),
+                _field_hash(latent),
+                _field_hash(image),
+            )
+        self.field_hashes = field_hashes
+
+    @classmethod
+    def from_any(cls, pipe):
+        """Accept a record or an old 7-tuple (no hash) / 8-tuple pipe."""
+        if pipe is None or isinstance(pipe, cls):
+            return pipe
+
+        if not isinstance(pipe, tuple):
+            pipe = tuple(pipe)
+
+        # Old-format compatibility: 7-tuple without hash -> prepend None hash.
+        if len(pipe) == 7:
+            pipe = (None,) + pipe
+        elif len(pipe) < 7:
+            # Very old/invalid, pad as best as we can.
+            pipe = (None,) + pipe + (None,) * (7 - len(pipe))
+        elif len(pipe) > 8:
+            # Ignore anything beyond expected 8 fields.
+            pipe = pipe[:8]
+
+        return cls(*pipe)
+
+    def updated(self, hash, model=None, clip=None, vae=None, positive=None, negative=None, latent=None, image=None, field_hashes=None):
+        """Record with the given hash and every non-None field replaced.
+
+        field_hashes, when given, are the fingerprints of the resulting
+        record (see AKPipe.run); otherwise they are recomputed.
+        """
+        if (
+            hash == self.hash
+            and (model is None or model is self.model)
+            and (clip is None or clip is self.clip)
+            and (vae is None or vae is self.vae)
+            and (positive is None or positive is self.positive)
+            and (negative is None or negative is self.negative)
+            and (latent is None or latent is self.latent)
+            and (image is None or image is self.image)
+        ):
+            return self
+        return AKPipeData(
+            hash,
+            self.model if model is None else model,
+            self.clip if clip is None else clip,
+            self.vae if vae is None else vae,
+            self.positive if positive is None else positive,
+            self.negative if negative is None else negative,
+            self.latent if latent is None else latent,
+            self.image if image is None else image,
+            field_hashes,
+        )
+
+    def field_hash(self, name):
+        return self.field_hashes[self.FIELDS.index(name)]
+
+    def changed_fields(self, other):
+        """Names of the fields whose fingerprint differs from other (a record or None)."""
+        if other is None:
+            return tuple(name for name, h in zip(self.FIELDS, self.field_hashes) if h is not None)
+        if other is self:
+            return ()
+        return tuple(
+            name
+            for name, a, b in zip(self.FIELDS, self.field_hashes, other.field_hashes)
+            if a != b
+        )
+
+    def outputs(self):
+        return (self, self.model, self.clip, self.vae, self.positive, self.negative, self.latent, self.image)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return tuple(self)[idx]
+        return getattr(self, self.TUPLE_FIELDS[idx])
+
+    def __len__(self):
+        return 8
+
+    def __iter__(self):
+        yield self.hash
+        yield self.model
+        yield self.clip
+        yield self.vae
+        yield self.positive
+        yield self.negative
+        yield self.latent
+        yield self.image
+
+    def __repr__(self):
+        return f"AKPipeData(v{self.version}, hash={self.hash!r})"
+
+
 class AKPipe:
     IDX_HASH = 0
     IDX_MODEL = 1
@@ -24,6 +244,9 @@ class AKPipe:
                 "latent": ("LATENT",),
                 "image": ("IMAGE",),
             },
+            "hidden": {
+                "unique_id": "UNIQUE_ID",
+            },
         }
 
     RETURN_TYPES = (
@@ -53,16 +276,8 @@ class AKPipe:
     OUTPUT_NODE = True
 
     def _hash_object(self, obj):
-        """Fast, small fingerprint of an object based on its repr, capped to 64KB."""
-        try:
-            s = repr(obj)
-        except Exception:
-            s = f"<obj {type(obj).__name__}>"
-        b = s.encode("utf-8", errors="ignore")
-        if len(b) > 65536:
-            b = b[:65536]
-        # built-in hash is fast and good enough within a single process
-        return hash(b)
+        """Constant-time fingerprint of an object (identity, shape, dtype, version)."""
+        return _field_hash(obj)
 
     def _combine_hashes(self, hashes):
         """Combine multiple integer hashes into a single hash value."""
@@ -74,26 +289,8 @@ class AKPipe:
         return hash(("AKPipe", id(self)))
 
     def _normalize_pipe(self, pipe_in):
-        """Normalize incoming pipe to (hash, model, clip, vae, pos, neg, latent, image)."""
-        if pipe_in is None:
-            return None
-
-        if isinstance(pipe_in, tuple):
-            pipe = pipe_in
-        else:
-            pipe = tuple(pipe_in)
-
-        # Old-format compatibility: 7-tuple without hash -> prepend None hash.
-        if len(pipe) == 7:
-            pipe = (None,) + pipe
-        elif len(pipe) < 7:
-            # Very old/invalid, pad as best as we can.
-            pipe = (None,) + pipe + (None,) * (7 - len(pipe))
-        elif len(pipe) > 8:
-            # Ignore anything beyond expected 8 fields.
-            pipe = pipe[:8]
-
-        return pipe
+        """Normalize incoming pipe (record or old tuple) to an AKPipeData."""
+        return AKPipeData.from_any(pipe_in)
 
     def run(
         self,
@@ -105,68 +302,34 @@ class AKPipe:
         negative=None,
         latent=None,
         image=None,
+        unique_id=None,
     ):
+        started = time.perf_counter() if AKPipeTrace.enabled() else None
+
         # Normalize incoming pipe (may be None or old/new format).
         pipe = self._normalize_pipe(pipe_in)
 
-        # Start from existing pipe or create a fresh one.
-        if pipe is None:
-            # New pipe: hash is None for now, rest from inputs.
-            out = [
-                None,
-                model,
-                clip,
-                vae,
-                positive,
-                negative,
-                latent,
-                image,
-            ]
+        # Fingerprint only the objects that came in on this call; the other
+        # fields keep the fingerprints carried by pipe_in.
+        incoming = (model, clip, vae, positive, negative, latent, image)
+        if pipe is not None:
+            field_hashes = list(pipe.field_hashes)
         else:
-            # Existing pipe: start from previous values.
-            out = list(pipe)
-            if len(out) < 8:
-                out.extend([None] * (8 - len(out)))
-
-            # Override with any non-None inputs.
-            if model is not None:
-                out[self.IDX_MODEL] = model
-            if clip is not None:
-                out[self.IDX_CLIP] = clip
-            if vae is not None:
-                out[self.IDX_VAE] = vae
-            if positive is not None:
-                out[self.IDX_POS] = positive
-            if negative is not None:
-                out[self.IDX_NEG] = negative
-            if latent is not None:
-                out[self.IDX_LATENT] = latent
-            if image is not None:
-                out[self.IDX_IMAGE] = image
-
-        # Determine which new objects actually came in on this call (excluding pipe_in).
-        hash_parts = []
-        if model is not None:
-            hash_parts.append(self._hash_object(model))
-        if clip is not None:
-            hash_parts.append(self._hash_object(clip))
-        if vae is not None:
-            hash_parts.append(self._hash_object(vae))
-        if positive is not None:
-            hash_parts.append(self._hash_object(positive))
-        if negative is not None:
-            hash_parts.append(self._hash_object(negative))
-        if latent is not None:
-            hash_parts.append(self._hash_object(latent))
-        if image is not None:
-            hash_parts.append(self._hash_object(image))
-
-        current_hash = out[self.IDX_HASH]
-
-        if hash_parts:
-            # There were new objects on the inputs (other than pipe_in):
-            # compute a fresh hash from these individual hashes.
-            combined_int = self._combine_hashes(hash_parts)
+            field_hashes = [None] * len(incoming)
+
+        has_new = False
+        for i, obj in enumerate(incoming):
+            if obj is not None:
+                field_hashes[i] = self._hash_object(obj)
+                has_new = True
+        field_hashes = tuple(field_hashes)
+
+        current_hash = pipe.hash if pipe is not None else None
+
+        if has_new:
+            # The pipe hash covers every field, so a change made upstream of
+            # pipe_in is still visible after this node sets other fields.
+            combined_int = self._combine_hashes(field_hashes)
             new_hash = str(combined_int)
         else:
             # No new objects: keep existing hash if any,
@@ -176,25 +339,79 @@ class AKPipe:
             else:
                 new_hash = current_hash
 
-        out[self.IDX_HASH] = new_hash
-        out_tuple = tuple(out)
-
-        return (
-            out_tuple,
-            out_tuple[self.IDX_MODEL],
-            out_tuple[self.IDX_CLIP],
-            out_tuple[self.IDX_VAE],
-            out_tuple[self.IDX_POS],
-            out_tuple[self.IDX_NEG],
-            out_tuple[self.IDX_LATENT],
-            out_tuple[self.IDX_IMAGE],
+        if pipe is None:
+            out = AKPipeData(new_hash, model, clip, vae, positive, negative, latent, image, field_hashes)
+        else:
+            # Shares the incoming record (or its untouched fields).
+            out = pipe.updated(new_hash, model, clip, vae, positive, negative, latent, image, field_hashes)
+
+        if started is not None:
+            self._trace(unique_id, started, pipe, out)
+
+        return out.outputs()
+
+    def _trace(self, unique_id, started, pipe, out):
+        # Only fingerprints of the previous output are kept, not its objects.
+        last = getattr(self, "_trace_last_hashes", None)
+        if last is None:
+            changed = list(out.changed_fields(None))
+        else:
+            changed = [n for n, a, b in zip(out.FIELDS, out.field_hashes, last) if a != b]
+        self._trace_last_hashes = out.field_hashes
+        AKPipeTrace.record(
+            type(self).__name__,
+            unique_id,
+            started,
+            hash=out.hash,
+            set_fields=list(out.changed_fields(pipe)),
+            changed_fields=changed,
+            reused_pipe=out is pipe,
+            field_bytes=AKPipeTrace.pipe_nbytes(out),
         )
 
 
+class AKPipeField:
+    """Extracts one field of a pipe together with that field's fingerprint."""
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "pipe_in": ("AK_PIPE",),
+                "field": (list(AKPipeData.FIELDS), {"default": "positive"}),
+            },
+        }
+
+    RETURN_TYPES = (ANY_TYPE, "STRING")
+    RETURN_NAMES = ("value", "fingerprint")
+
+    FUNCTION = "run"
+    CATEGORY = "AK/Pipe"
+    OUTPUT_NODE = False
+
+    def run(self, pipe_in, field):
+        pipe = AKPipeData.from_any(pipe_in)
+        if pipe is None:
+            return (None, "")
+        h = pipe.field_hash(field)
+        return (getattr(pipe, field), "" if h is None else f"{field}:{h}")
+
+
+class AKPipePrunable(AKPipe):
+    """Same as AK Pipe, but not an output node: ComfyUI only runs it (and its
+    upstream) when something downstream uses its outputs."""
+
+    OUTPUT_NODE = False
+
+
 NODE_CLASS_MAPPINGS = {
     "AK Pipe": AKPipe,
+    "AK Pipe Prunable": AKPipePrunable,
+    "AK Pipe Field": AKPipeField,
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
     "AK Pipe": "AK Pipe",
+    "AK Pipe Prunable": "AK Pipe (Prunable)",
+    "AK Pipe Field": "AK Pipe Field",
 }
@@ -1,5 +1,11 @@
 # AKPipeLoop.py
 
+import time
+
+from . import AKPipeTrace
+from .AKPipe import AKPipeData
+
+
 class AKPipeLoop:
     IDX_HASH = 0
     IDX_MODEL = 1
@@ -17,15 +23,19 @@ class AKPipeLoop:
                 "pipe_in_1": ("AK_PIPE",),
             },
             "optional": {
-                "pipe_in_2": ("AK_PIPE",),
-                "pipe_in_3": ("AK_PIPE",),
-                "pipe_in_4": ("AK_PIPE",),
-                "pipe_in_5": ("AK_PIPE",),
-                "pipe_in_6": ("AK_PIPE",),
-                "pipe_in_7": ("AK_PIPE",),
-                "pipe_in_8": ("AK_PIPE",),
-                "pipe_in_9": ("AK_PIPE",),
-                "pipe_in_10": ("AK_PIPE",),
+                "pipe_in_2": ("AK_PIPE", {"lazy": True}),
+                "pipe_in_3": ("AK_PIPE", {"lazy": True}),
+                "pipe_in_4": ("AK_PIPE", {"lazy": True}),
+                "pipe_in_5": ("AK_PIPE", {"lazy": True}),
+                "pipe_in_6": ("AK_PIPE", {"lazy": True}),
+                "pipe_in_7": ("AK_PIPE", {"lazy": True}),
+                "pipe_in_8": ("AK_PIPE", {"lazy": True}),
+                "pipe_in_9": ("AK_PIPE", {"lazy": True}),
+                "pipe_in_10": ("AK_PIPE", {"lazy": True}),
+            },
+            "hidden": {
+                "unique_id": "UNIQUE_ID",
+                "prompt": "PROMPT",
             },
         }
 
@@ -55,54 +65,75 @@ class AKPipeLoop:
     CATEGORY = "AK/Pipe"
     OUTPUT_NODE = True
 
+    # unique_id -> fingerprint IS_CHANGED reports for the next run.
+    _next_fingerprint = {}
+
     @classmethod
-    def IS_CHANGED(cls, **kwargs):
-        # Force this node to always re-run
-        return float("nan")
+    def IS_CHANGED(cls, unique_id=None, **kwargs):
+        # Linked pipes are not available here, so run() leaves behind the
+        # fingerprint ("index:hash") of the pipe it will select if no input
+        # changes. When upstream is unchanged and that equals what it already
+        # returned, ComfyUI keeps the cached result; upstream changes
+        # invalidate the node through its input signature as usual.
+        fp = cls._next_fingerprint.get(str(unique_id))
+        if fp is None:
+            return float("nan")
+        return fp
+
+    INPUT_NAMES = tuple(f"pipe_in_{i}" for i in range(1, 11))
 
     def __init__(self):
         # Stored hashes per input index (0..9 for pipe_in_1..pipe_in_10).
         self._stored_hashes = {}
 
-    def _normalize_pipe(self, pipe):
-        if pipe is None:
+    def _linked_inputs(self, prompt, unique_id):
+        """Indices of pipe inputs that are connected in the prompt, or None if unknown."""
+        try:
+            node_inputs = prompt[str(unique_id)]["inputs"]
+        except Exception:
             return None
+        return {
+            idx for idx, name in enumerate(self.INPUT_NAMES)
+            if isinstance(node_inputs.get(name), list)
+        }
 
-        if not isinstance(pipe, tuple):
-            pipe = tuple(pipe)
+    def check_lazy_status(self, unique_id=None, prompt=None, **kwargs):
+        # Pull inputs one at a time, in order. The first input whose hash
+        # changed is the one run() forwards, so every branch after it is
+        # never evaluated. Only when nothing changed are all inputs needed
+        # (to find the last connected one).
+        # Connected inputs are always present in kwargs, unevaluated ones as None.
+        # An input without a stored hash (first run, new link) would count as
+        # changed and stop the walk at itself, so until every connected input
+        # has a baseline all of them are pulled, like the eager node did.
+        missing = [
+            name for idx, name in enumerate(self.INPUT_NAMES)
+            if name in kwargs and idx not in self._stored_hashes
+        ]
+        if missing:
+            return [name for name in self.INPUT_NAMES if name in kwargs and kwargs[name] is None]
 
-        # Old format: 7-tuple without hash -> prepend None hash.
-        if len(pipe) == 7:
-            pipe = (None,) + pipe
-        elif len(pipe) < 7:
-            pipe = (None,) + pipe + (None,) * (7 - len(pipe))
-        elif len(pipe) > 8:
-            pipe = pipe[:8]
+        for idx, name in enumerate(self.INPUT_NAMES):
+            if name not in kwargs:
+                continue
+            value = kwargs[name]
+            if value is None:
+                return [name]
+            h = self._get_hash_from_pipe(self._normalize_pipe(value))
+            if idx not in self._stored_hashes or h != self._stored_hashes[idx]:
+                return []
+        return []
 
-        return pipe
+    def _normalize_pipe(self, pipe):
+        return AKPipeData.from_any(pipe)
 
     def _get_hash_from_pipe(self, pipe):
         if pipe is None:
             return None
-        if not isinstance(pipe, tuple):
-            pipe = tuple(pipe)
-        if len(pipe) == 0:
-            return None
-        # If it is old 7-tuple without hash, treat hash as None.
-        if len(pipe) == 7:
-            return None
-        return pipe[self.IDX_HASH]
+        return pipe.hash
 
     def _outputs_from_pipe(self, pipe):
-        # Assumes pipe is already normalized to at least 8 elements.
-        model = pipe[self.IDX_MODEL]
-        clip = pipe[self.IDX_CLIP]
-        vae = pipe[self.IDX_VAE]
-        positive = pipe[self.IDX_POS]
-        negative = pipe[self.IDX_NEG]
-        latent = pipe[self.IDX_LATENT]
-        image = pipe[self.IDX_IMAGE]
-        return (pipe, model, clip, vae, positive, negative, latent, image)
+        return pipe.outputs()
 
     def run(
         self,
@@ -116,7 +147,11 @@ class AKPipeLoop:
         pipe_in_8=None,
         pipe_in_9=None,
         pipe_in_10=None,
+        unique_id=None,
+        prompt=None,
     ):
+        started = time.perf_counter() if AKPipeTrace.enabled() else None
+
         inputs = [
             pipe_in_1,
             pipe_in_2,
@@ -151,34 +186,80 @@ class AKPipeLoop:
             if idx not in self._stored_hashes or h != prev:
                 changed_indices.append(idx)
 
+        # Inputs skipped by lazy evaluation keep their last seen hash as
+        # long as they are still connected.
+        linked = self._linked_inputs(prompt, unique_id)
+        if linked:
+            for idx, h in self._stored_hashes.items():
+                if idx in linked and idx not in current_hashes:
+                    current_hashes[idx] = h
+
         # Update stored hashes snapshot to current state
         self._stored_hashes = current_hashes
 
-        # If there is at least one changed input, use the first one
         if changed_indices:
-            first_idx = changed_indices[0]
-            pipe = normalized_pipes[first_idx]
-            return self._outputs_from_pipe(pipe)
+            # If there is at least one changed input, use the first one
+            selected_idx = changed_indices[0]
+            reason = "changed"
+        elif normalized_pipes:
+            # No hashes changed: choose the last non-None current input
+            selected_idx = max(normalized_pipes)
+            reason = "last_non_none"
+        else:
+            selected_idx = None
+            reason = "empty"
+
+        self._remember_next_fingerprint(unique_id, selected_idx, current_hashes)
+
+        if started is not None:
+            selected = normalized_pipes.get(selected_idx)
+            AKPipeTrace.record(
+                type(self).__name__,
+                unique_id,
+                started,
+                selected=None if selected_idx is None else self.INPUT_NAMES[selected_idx],
+                reason=reason,
+                evaluated=[self.INPUT_NAMES[i] for i in sorted(normalized_pipes)],
+                changed=[self.INPUT_NAMES[i] for i in changed_indices],
+                hash=None if selected is None else selected.hash,
+                field_bytes=AKPipeTrace.pipe_nbytes(selected),
+            )
+
+        if selected_idx is None:
+            # Degenerate empty outputs if nothing valid found
+            return (None, None, None, None, None, None, None, None)
+        return self._outputs_from_pipe(normalized_pipes[selected_idx])
+
+    def _remember_next_fingerprint(self, unique_id, selected_idx, current_hashes):
+        if unique_id is None:
+            return
+        key = str(unique_id)
+        if selected_idx is None:
+            self._next_fingerprint.pop(key, None)
+            return
+        # With unchanged inputs the next run picks the last non-None pipe.
+        # Only report a stable value if that is what this run returned,
+        # otherwise the cached result would be stale.
+        next_idx = max(current_hashes)
+        if next_idx != selected_idx:
+            self._next_fingerprint.pop(key, None)
+            return
+        self._next_fingerprint[key] = f"{next_idx}:{current_hashes[next_idx]}"
 
-        # No hashes changed: choose the last non-None current input
-        last_pipe = None
-        for raw_pipe in inputs:
-            if raw_pipe is not None:
-                p = self._normalize_pipe(raw_pipe)
-                if p is not None:
-                    last_pipe = p
 
-        if last_pipe is not None:
-            return self._outputs_from_pipe(last_pipe)
+class AKPipeLoopPrunable(AKPipeLoop):
+    """Same as AK Pipe Loop, but not an output node: ComfyUI only runs it (and its
+    upstream) when something downstream uses its outputs."""
 
-        # Degenerate empty outputs if nothing valid found
-        return (None, None, None, None, None, None, None, None)
+    OUTPUT_NODE = False
 
 
 NODE_CLASS_MAPPINGS = {
     "AK Pipe Loop": AKPipeLoop,
+    "AK Pipe Loop Prunable": AKPipeLoopPrunable,
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
     "AK Pipe Loop": "AK Pipe Loop",
+    "AK Pipe Loop Prunable": "AK Pipe Loop (Prunable)",
 }
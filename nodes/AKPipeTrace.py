@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+from collections import deque
+
+from .CondCache import tensor_nbytes, server_routes
+
+# Opt-in hop trace for AK Pipe / AK Pipe Loop, off unless AK_PIPE_TRACE=1.
+PIPE_TRACE_ENABLED = os.environ.get("AK_PIPE_TRACE", "0").strip().lower() in ("1", "true", "yes", "on")
+PIPE_TRACE_MAX_RECORDS = int(os.environ.get("AK_PIPE_TRACE_MAX_RECORDS", "2000"))
+
+_lock = threading.Lock()
+_records = deque(maxlen=PIPE_TRACE_MAX_RECORDS or None)
+_seq = 0
+
+
+def enabled():
+    return PIPE_TRACE_ENABLED
+
+
+def set_enabled(value):
+    global PIPE_TRACE_ENABLED
+    PIPE_TRACE_ENABLED = bool(value)
+
+
+def field_nbytes(value, seen=None, depth=0):
+    """Bytes of the tensors directly held by a pipe field, or None.
+
+    Covers IMAGE tensors, LATENT dicts and CONDITIONING lists. Models, CLIP
+    and VAE objects are not walked and report None.
+    """
+    if value is None:
+        return None
+    if seen is None:
+        seen = set()
+    if hasattr(value, "element_size") and hasattr(value, "numel"):
+        if id(value) in seen:
+            return 0
+        seen.add(id(value))
+        return tensor_nbytes(value)
+    if depth >= 3:
+        return 0
+    if isinstance(value, dict):
+        items = value.values()
+    elif isinstance(value, (list, tuple)):
+        items = value
+    else:
+        return None
+    total = 0
+    for item in items:
+        n = field_nbytes(item, seen, depth + 1)
+        if n:
+            total += n
+    return total
+
+
+def pipe_nbytes(pipe):
+    """{field: bytes} for the fields of an AKPipeData record that hold tensors."""
+    out = {}
+    if pipe is None:
+        return out
+    seen = set()
+    for name in pipe.FIELDS:
+        n = field_nbytes(getattr(pipe, name), seen)
+        if n is not None:
+            out[name] = n
+    return out
+
+
+def record(node, unique_id, started, **data):
+    """Append one hop record; `started` is the time.perf_counter() at hop start."""
+    global _seq
+    entry = {
+        "node": node,
+        "unique_id": None if unique_id is None else str(unique_id),
+        "time": time.time(),
+        "duration_ms": round((time.perf_counter() - started) * 1000.0, 4),
+    }
+    entry.update(data)
+    with _lock:
+        _seq += 1
+        entry["seq"] = _seq
+        _records.append(entry)
+
+
+def trace_records():
+    with _lock:
+        return list(_records)
+
+
+def clear_trace():
+    with _lock:
+        _records.clear()
+
+
+def _register_routes():
+    server = server_routes()
+    if server is None:
+        return
+    web, routes = server
+
+    @routes.get("/ak/pipe/trace")
+    async def _pipe_trace(request):
+        body = {"enabled": enabled(), "records": trace_records()}
+        headers = None
+        if request.rel_url.query.get("download") in ("1", "true"):
+            headers = {"Content-Disposition": 'attachment; filename="ak_pipe_trace.json"'}
+        return web.json_response(body, headers=headers)
+
+    @routes.post("/ak/pipe/trace")
+    async def _pipe_trace_update(request):
+        # JSON body: {"enable": true/false, "clear": true}
+        try:
+            data = await request.json()
+        except Exception:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        if "enable" in data:
+            set_enabled(bool(data["enable"]))
+        if data.get("clear"):
+            clear_trace()
+        return web.json_response({"enabled": enabled(), "records": len(trace_records())})
+
+
+_register_routes()
@@ -1,4 +1,7 @@
-import zlib
+import hashlib
+
+from .CondCache import CondLRU, COND_CACHE_MAX_ENTRIES, clip_cache_key, encode_timer, begin_flight, end_flight, wait_flight, disk_load, disk_save
+from .CLIPTextEncodeCached import CLIPTextEncodeCached
 
 
 class AnyType(str):
@@ -10,12 +13,13 @@ ANY_TYPE = AnyType("*")
 
 
 class CLIPEncodeMultiple:
-    empty_cache = {}
-    # text_cache = {}
-
-    last_items = None
-    idx_cache = {}
-    hash_cache = {}
+    # Bounded LRUs keyed by clip_cache_key(clip) + (...). Entries are dropped as
+    # soon as the CLIP model they were encoded with is garbage collected.
+    empty_cache = CondLRU("CLIPEncodeMultiple.empty")
+    # (clip_key, text) -> conditioning, independent of the string's position.
+    # One node can hold up to 20 strings, so allow more entries than the default.
+    text_cache = CondLRU("CLIPEncodeMultiple.text", max_entries=COND_CACHE_MAX_ENTRIES * 4)
+    hash_cache = CondLRU("CLIPEncodeMultiple.hash")
 
     @classmethod
     def INPUT_TYPES(cls):
@@ -42,32 +46,90 @@ class CLIPEncodeMultiple:
 
     @classmethod
     def _get_empty_cond(cls, clip):
-        key = id(clip)
+        key = cls._clip_key(clip)
         cached = cls.empty_cache.get(key)
         if cached is not None:
             return cached
 
         tokens = clip.tokenize("")
-        cond, pooled = clip.encode_from_tokens(tokens, return_pooled=True)
+        with encode_timer("CLIPEncodeMultiple"):
+            cond, pooled = clip.encode_from_tokens(tokens, return_pooled=True)
         empty = [[cond, {"pooled_output": pooled}]]
-        cls.empty_cache[key] = empty
+        cls.empty_cache.put(key, empty)
         return empty
 
     @classmethod
     def _encode_text(cls, clip, text):
+        cond = disk_load(clip, text)
+        if cond is not None:
+            return cond
         tokens = clip.tokenize(text)
-        cond, pooled = clip.encode_from_tokens(tokens, return_pooled=True)
-        return [[cond, {"pooled_output": pooled}]]
+        with encode_timer("CLIPEncodeMultiple"):
+            cond, pooled = clip.encode_from_tokens(tokens, return_pooled=True)
+        conditioning = [[cond, {"pooled_output": pooled}]]
+        disk_save(clip, text, conditioning)
+        return conditioning
+
+    @classmethod
+    def _encode_batch(cls, clip, texts):
+        """Encode several texts together through the chunk cache of
+        CLIPTextEncodeCached, or return None when the tokenizer layout does
+        not allow it.
+
+        Missing 77-token chunks of all texts are encoded in shared passes;
+        each text's first chunk leads its own pass unless its pooled output
+        is already known, so every result keeps the pooled output
+        CLIPTextEncode would return.
+        """
+        token_sets = [clip.tokenize(t) for t in texts]
+        return CLIPTextEncodeCached._encode_chunked_many(
+            clip, token_sets, cls._clip_key(clip), timer="CLIPEncodeMultiple"
+        )
+
+    @classmethod
+    def _encode_texts(cls, clip, texts):
+        """Encode unique texts, batching the ones not found on disk. Returns {text: cond}."""
+        encoded = {}
+        pending = []
+        for text in texts:
+            if text in encoded or text in pending:
+                continue
+            cond = disk_load(clip, text)
+            if cond is not None:
+                encoded[text] = cond
+            else:
+                pending.append(text)
+
+        if len(pending) > 1:
+            batch = cls._encode_batch(clip, pending)
+            if batch is not None:
+                for text, cond in zip(pending, batch):
+                    disk_save(clip, text, cond)
+                    encoded[text] = cond
+                pending = []
+
+        for text in pending:
+            encoded[text] = cls._encode_text(clip, text)
+        return encoded
 
     @staticmethod
     def _clip_key(clip):
-        inner = getattr(clip, "cond_stage_model", None)
-        if inner is not None:
-            return id(inner)
-        inner = getattr(clip, "clip", None) or getattr(clip, "model", None)
-        if inner is not None:
-            return id(inner)
-        return id(clip)
+        # Base model identity plus LoRA/patch fingerprint, shared by clones.
+        return clip_cache_key(clip)
+
+    @classmethod
+    def cache_info(cls):
+        return {
+            "empty": cls.empty_cache.info(),
+            "text": cls.text_cache.info(),
+            "hash": cls.hash_cache.info(),
+        }
+
+    @classmethod
+    def clear_cache(cls):
+        cls.empty_cache.clear()
+        cls.text_cache.clear()
+        cls.hash_cache.clear()
 
     @staticmethod
     def _apply_mask_to_cond(base_cond, mask):
@@ -83,48 +145,51 @@ class CLIPEncodeMultiple:
 
     @classmethod
     def _compute_hash(cls, items, masks, start, length):
-        max_bytes = 64 * 1024
-        buf = bytearray()
-
-        def add_bytes(b):
-            nonlocal buf
-            if not b:
-                return
-            remaining = max_bytes - len(buf)
-            if remaining <= 0:
-                return
-            if len(b) > remaining:
-                buf.extend(b[:remaining])
-            else:
-                buf.extend(b)
-
+        """Fingerprint of the node inputs used as the hash_cache key.
+
+        Every string is hashed in full (length-prefixed, so item boundaries
+        are unambiguous). Masks are identified by object identity, shape,
+        dtype, device, storage pointer and in-place version counter (none
+        for inference tensors) instead of their data, so no mask is copied
+        to the host. Only masks in the selected range matter for the result;
+        those are kept alive by the cached conditioning, so their id() cannot
+        be reused while the entry exists.
+        """
+        h = hashlib.blake2b(digest_size=20)
+
+        h.update(f"n={len(items)}\n".encode("ascii"))
         for v in items:
-            s = "" if v is None else v
-            add_bytes(s.encode("utf-8", errors="ignore") + b"\n")
-            if len(buf) >= max_bytes:
-                break
-
-        if len(buf) < max_bytes and masks:
-            for m in masks:
-                if m is None:
-                    add_bytes(b"MNONE\n")
-                else:
-                    try:
-                        t = m
-                        if isinstance(t, (list, tuple)):
-                            t = t[0]
-                        if hasattr(t, "detach"):
-                            t = t.detach()
-                        arr = t.cpu().contiguous().numpy()
-                        add_bytes(arr.tobytes())
-                    except Exception:
-                        add_bytes(repr(type(m)).encode("utf-8", errors="ignore"))
-                if len(buf) >= max_bytes:
-                    break
-
-        add_bytes(f"|start={start}|len={length}".encode("ascii"))
-
-        return zlib.adler32(bytes(buf)) & 0xFFFFFFFF
+            if v is None:
+                h.update(b"N\n")
+                continue
+            b = v.encode("utf-8", errors="surrogatepass")
+            h.update(f"S{len(b)}:".encode("ascii"))
+            h.update(b)
+
+        for idx in range(start, start + length):
+            m = masks[idx] if 0 <= idx < len(masks) else None
+            if m is None:
+                h.update(b"MNONE\n")
+                continue
+            t = m[0] if isinstance(m, (list, tuple)) and m else m
+            try:
+                # Tensors made under torch.inference_mode() (how ComfyUI
+                # runs nodes) have no version counter.
+                sig = (
+                    id(t),
+                    tuple(t.shape),
+                    str(t.dtype),
+                    str(t.device),
+                    t.data_ptr(),
+                    None if t.is_inference() else t._version,
+                )
+            except Exception:
+                sig = (id(t), type(t).__name__)
+            h.update(repr(sig).encode("ascii", errors="backslashreplace"))
+
+        h.update(f"|start={start}|len={length}".encode("ascii"))
+
+        return h.hexdigest()
 
     def execute(self, clip, str_list, starting_index, length, mask_list=None):
         if isinstance(clip, (list, tuple)):
@@ -168,15 +233,11 @@ class CLIPEncodeMultiple:
         start = max(0, int(start_raw))
         length_val = max(1, min(20, int(length_raw)))
 
-        if CLIPEncodeMultiple.last_items is None or len(CLIPEncodeMultiple.last_items) != len(items):
-            CLIPEncodeMultiple.last_items = [None] * len(items)
-            CLIPEncodeMultiple.idx_cache.clear()
-
         clip_id = self._clip_key(clip_obj)
         items_copy = list(items)
         masks_copy = list(masks) if masks else []
         hval = self._compute_hash(items_copy, masks_copy, start, length_val)
-        cache_key = (clip_id, hval)
+        cache_key = clip_id + (hval,)
 
         cached_entry = CLIPEncodeMultiple.hash_cache.get(cache_key)
         if cached_entry is not None:
@@ -188,6 +249,47 @@ class CLIPEncodeMultiple:
                 per_idx_cached = per_idx_cached[:20]
             return (combined_cached,) + tuple(per_idx_cached)
 
+        # First pass: look every string up once, then encode all misses together.
+        encoded = {}
+        to_encode = []
+        for i in range(length_val):
+            idx = start + i
+            if not (0 <= idx < len(items)):
+                continue
+            v = items[idx]
+            if v is None or v in encoded or v in to_encode:
+                continue
+            cached = CLIPEncodeMultiple.text_cache.get(clip_id + (v,))
+            if cached is not None:
+                encoded[v] = cached
+            else:
+                to_encode.append(v)
+
+        if to_encode:
+            # Strings another node is encoding right now are awaited instead
+            # of being encoded twice; the rest are encoded here in one batch.
+            leading = []
+            waiting = []
+            for v in to_encode:
+                fkey = ("CLIPEncodeMultiple",) + clip_id + (v,)
+                flight, leader = begin_flight(fkey)
+                (leading if leader else waiting).append((v, fkey, flight))
+
+            if leading:
+                try:
+                    fresh = self._encode_texts(clip_obj, [v for v, _, _ in leading])
+                except BaseException as e:
+                    for _, fkey, flight in leading:
+                        end_flight(fkey, flight, error=e)
+                    raise
+                for v, fkey, flight in leading:
+                    CLIPEncodeMultiple.text_cache.put(clip_id + (v,), fresh[v])
+                    end_flight(fkey, flight, result=fresh[v])
+                encoded.update(fresh)
+
+            for v, _, flight in waiting:
+                encoded[v] = wait_flight(flight)
+
         result = []
         empty_cond = None
         combined_cond = None
@@ -207,20 +309,8 @@ class CLIPEncodeMultiple:
                     if empty_cond is None:
                         empty_cond = self._get_empty_cond(clip_obj)
                     base_cond = empty_cond
-                    CLIPEncodeMultiple.last_items[idx] = None
                 else:
-                    prev = CLIPEncodeMultiple.last_items[idx]
-                    if v == prev:
-                        cached = CLIPEncodeMultiple.idx_cache.get((clip_id, idx))
-                        if cached is not None:
-                            base_cond = cached
-                        else:
-                            base_cond = self._encode_text(clip_obj, v)
-                            CLIPEncodeMultiple.idx_cache[(clip_id, idx)] = base_cond
-                    else:
-                        base_cond = self._encode_text(clip_obj, v)
-                        CLIPEncodeMultiple.idx_cache[(clip_id, idx)] = base_cond
-                        CLIPEncodeMultiple.last_items[idx] = v
+                    base_cond = encoded[v]
 
                 cond = self._apply_mask_to_cond(base_cond, mask_for_idx)
                 if v is not None and cond is not None:
@@ -235,7 +325,7 @@ class CLIPEncodeMultiple:
         if length_val < 20:
             result.extend([None] * (20 - length_val))
 
-        CLIPEncodeMultiple.hash_cache[cache_key] = (combined_cond, list(result))
+        CLIPEncodeMultiple.hash_cache.put(cache_key, (combined_cond, list(result)))
 
         return (combined_cond,) + tuple(result)
 
@@ -1,8 +1,25 @@
+import threading
+
+import torch
+
+from .CondCache import CondLRU, COND_CACHE_MAX_ENTRIES, normalize_text, clip_cache_key, encode_timer, single_flight, disk_load, disk_save
+
+# Tokenizer keys whose 77-token chunks are encoded independently of each other
+# (CLIP-L, CLIP-G, CLIP-H). Layouts with any other encoder (e.g. T5) are
+# encoded as a whole.
+CHUNKED_TOKEN_KEYS = frozenset(("l", "g", "h"))
+
+# Serializes the encoder hook in _encode_rows.
+_row_pooled_lock = threading.Lock()
+
+
 class CLIPTextEncodeCached:
-    # Runtime cache: text_hash -> conditioning
-    _last_text = None
-    _last_cond = None
-    _last_clip_id = None
+    # Runtime cache shared by all instances: (clip_key..., text) -> conditioning.
+    # Entry limit from AK_COND_CACHE_MAX_ENTRIES; bytes count against the
+    # AK_COND_CACHE_MAX_MB budget shared by all conditioning caches.
+    _cache = CondLRU("CLIPTextEncodeCached")
+    # (clip_key..., chunk token ids/weights) -> (cond_slice, pooled, pooled_known)
+    _chunk_cache = CondLRU("CLIPTextEncodeCached.chunk", max_entries=COND_CACHE_MAX_ENTRIES * 4)
 
     @classmethod
     def INPUT_TYPES(cls):
@@ -22,26 +39,220 @@ class CLIPTextEncodeCached:
     CATEGORY = "conditioning"
     OUTPUT_NODE = False
 
+    @staticmethod
+    def _chunk_signatures(tokens):
+        """Per-chunk hashable signatures for a chunked tokenizer output, or None.
+
+        A chunk spans the same index in every tokenizer key (for SDXL the
+        g and l chunks are encoded separately and joined on the feature dim).
+        """
+        if not isinstance(tokens, dict) or not tokens:
+            return None
+        names = tuple(sorted(tokens.keys()))
+        if not CHUNKED_TOKEN_KEYS.issuperset(names):
+            return None
+
+        count = len(tokens[names[0]])
+        chunk_len = None
+        per_name = []
+        for name in names:
+            chunks = tokens[name]
+            if len(chunks) != count:
+                return None
+            sigs = []
+            for chunk in chunks:
+                if chunk_len is None:
+                    chunk_len = len(chunk)
+                elif len(chunk) != chunk_len:
+                    return None
+                ids = tuple(pair[0] for pair in chunk)
+                # Textual-inversion embeddings come in as tensors, not ids.
+                if not all(isinstance(i, int) for i in ids):
+                    return None
+                sigs.append((ids, tuple(float(pair[1]) for pair in chunk)))
+            per_name.append(sigs)
+
+        if not count:
+            return None
+        return names, chunk_len, [tuple(zip(names, parts)) for parts in zip(*per_name)]
+
     @classmethod
-    def execute(cls, clip, text):
-        if text is None:
-            text = ""
+    def _encode_chunked(cls, clip, tokens, clip_key):
+        """Encode only the chunks not in the chunk cache and join the result.
+
+        The pooled output of a prompt is the pooled output of its first
+        chunk, which is only returned when that chunk is the first row of an
+        encode call; it is re-encoded up front when not known yet.
+        Returns None when the tokens cannot be handled chunk-wise.
+        """
+        out = cls._encode_chunked_many(clip, [tokens], clip_key)
+        return None if out is None else out[0]
+
+    @staticmethod
+    def _encode_rows(clip, sub, rows, timer, texts):
+        """encode_from_tokens on `rows` chunk rows -> (cond, pooled, pooled per row).
+
+        encode_from_tokens keeps only the first row's pooled output, but the
+        per-encoder encode() it calls (cond_stage_model.clip_l/_g/_h) returns
+        one pooled row per chunk. That call is observed for the duration of
+        the encode; the pooled rows are used when their first row matches
+        the pooled output ComfyUI returned. Otherwise only row 0's pooled
+        output is known and None is returned in place of the list.
+        """
+        model = getattr(clip, "cond_stage_model", None)
+        encoders = []
+        for name in sub:
+            enc = getattr(model, f"clip_{name}", None)
+            if enc is not None and callable(getattr(enc, "encode", None)):
+                encoders.append(enc)
+
+        captured = []
+        caller = threading.get_ident()
 
-        text = text.replace("\r\n", "\n").replace("\r", "\n")
+        def hook(encode):
+            def encode_rows(tokens, *args, **kwargs):
+                o = encode(tokens, *args, **kwargs)
+                if threading.get_ident() == caller:
+                    try:
+                        captured.append(o[1])
+                    except Exception:
+                        pass
+                return o
+            return encode_rows
 
-        clip_id = id(clip)
+        with _row_pooled_lock:
+            saved = [(enc, enc.__dict__.get("encode")) for enc in encoders]
+            for enc, _ in saved:
+                enc.__dict__["encode"] = hook(enc.encode)
+            try:
+                with encode_timer(timer, texts=texts):
+                    cond, pooled = clip.encode_from_tokens(sub, return_pooled=True)
+            finally:
+                for enc, old in saved:
+                    if old is None:
+                        enc.__dict__.pop("encode", None)
+                    else:
+                        enc.__dict__["encode"] = old
 
-        if cls._last_clip_id == clip_id and cls._last_text == text and cls._last_cond is not None:
-            return (cls._last_cond,)
+        if rows == 1 or pooled is None:
+            return cond, pooled, [pooled] * rows
+        for p in captured:
+            try:
+                if p is None or p.shape[0] < rows:
+                    continue
+                first = p[0:1].to(pooled.device)
+                if first.shape == pooled.shape and torch.equal(first, pooled):
+                    return cond, pooled, [pooled] + [p[j:j + 1].to(pooled.device) for j in range(1, rows)]
+            except Exception:
+                continue
+        return cond, pooled, None
+
+    @classmethod
+    def _encode_chunked_many(cls, clip, token_sets, clip_key, timer="CLIPTextEncodeCached"):
+        """Chunk-cached encode of several tokenized prompts, one conditioning each.
+
+        Chunks shared by several prompts are encoded once, and all missing
+        chunks go into one encode call. The first chunk of every prompt needs
+        its pooled output; when the encoder does not report it per row (see
+        _encode_rows), the remaining first chunks are encoded one call each.
+        Returns None when the tokens cannot be handled chunk-wise.
+        """
+        layouts = [cls._chunk_signatures(tokens) for tokens in token_sets]
+        if not layouts or any(layout is None for layout in layouts):
+            return None
+        names, chunk_len = layouts[0][:2]
+        if any(layout[:2] != (names, chunk_len) for layout in layouts):
+            return None
+
+        entries = {}
+        chunk_tokens = {}
+        for tokens, (_, _, sigs) in zip(token_sets, layouts):
+            for i, sig in enumerate(sigs):
+                if sig not in entries:
+                    entries[sig] = cls._chunk_cache.get(clip_key + (sig,))
+                    chunk_tokens[sig] = {name: tokens[name][i] for name in names}
+
+        heads = []
+        for _, _, sigs in layouts:
+            entry = entries[sigs[0]]
+            if (entry is None or not entry[2]) and sigs[0] not in heads:
+                heads.append(sigs[0])
+        pending = heads + [sig for sig, entry in entries.items() if entry is None and sig not in heads]
+
+        batched = True
+        texts = len(token_sets)
+        while pending:
+            call = pending if batched else pending[:1]
+            sub = {name: [chunk_tokens[sig][name] for sig in call] for name in names}
+            cond, pooled, pooled_rows = cls._encode_rows(clip, sub, len(call), timer, texts)
+            texts = 0
+            if cond.shape[-2] != chunk_len * len(call):
+                return None
+            for j, sig in enumerate(call):
+                part = cond[:, j * chunk_len:(j + 1) * chunk_len].clone()
+                old = entries[sig]
+                if pooled_rows is not None:
+                    entry = (part, pooled_rows[j], True)
+                elif j == 0:
+                    entry = (part, pooled, True)
+                elif old is not None:
+                    entry = (part, old[1], old[2])
+                else:
+                    entry = (part, None, False)
+                entries[sig] = entry
+                cls._chunk_cache.put(clip_key + (sig,), entry)
+            if pooled_rows is None:
+                batched = False
+            pending = [sig for sig in heads if not entries[sig][2]]
+
+        out = []
+        for _, _, sigs in layouts:
+            parts = [entries[sig] for sig in sigs]
+            if len(parts) == 1:
+                cond = parts[0][0]
+            else:
+                cond = torch.cat([e[0] for e in parts], dim=-2)
+            out.append([[cond, {"pooled_output": parts[0][1]}]])
+        return out
+
+    @classmethod
+    def _load_or_encode(cls, clip, text, clip_key, key):
+        # Another thread may have finished the same text while we waited.
+        conditioning = cls._cache.peek(key)
+        if conditioning is not None:
+            return conditioning
+
+        conditioning = disk_load(clip, text)
+        if conditioning is not None:
+            cls._cache.put(key, conditioning)
+            return conditioning
 
         tokens = clip.tokenize(text)
-        cond, pooled = clip.encode_from_tokens(tokens, return_pooled=True)
-        conditioning = [[cond, {"pooled_output": pooled}]]
+        conditioning = cls._encode_chunked(clip, tokens, clip_key)
+        if conditioning is None:
+            with encode_timer("CLIPTextEncodeCached"):
+                cond, pooled = clip.encode_from_tokens(tokens, return_pooled=True)
+            conditioning = [[cond, {"pooled_output": pooled}]]
+
+        cls._cache.put(key, conditioning)
+        disk_save(clip, text, conditioning)
+        return conditioning
+
+    @classmethod
+    def execute(cls, clip, text):
+        text = normalize_text(text)
 
-        cls._last_clip_id = clip_id
-        cls._last_text = text
-        cls._last_cond = conditioning
+        clip_key = clip_cache_key(clip)
+        key = clip_key + (text,)
+        cached = cls._cache.get(key)
+        if cached is not None:
+            return (cached,)
 
+        # Nodes encoding the same text at the same time share one encode.
+        conditioning = single_flight(
+            ("CLIPTextEncodeCached",) + key,
+            lambda: cls._load_or_encode(clip, text, clip_key, key),
+        )
         return (conditioning,)
 
 
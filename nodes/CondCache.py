@@ -0,0 +1,766 @@
+# CondCache.py
+# Shared conditioning caches used by the CLIP encode nodes:
+# a bounded in-memory LRU and an optional safetensors disk tier.
+
+import os
+import time
+import threading
+import hashlib
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+COND_CACHE_MAX_ENTRIES = int(os.environ.get("AK_COND_CACHE_MAX_ENTRIES", "64"))
+COND_CACHE_MAX_MB = float(os.environ.get("AK_COND_CACHE_MAX_MB", "512"))
+
+# Optional disk tier, off unless AK_COND_DISK_CACHE=1.
+COND_DISK_CACHE_ENABLED = os.environ.get("AK_COND_DISK_CACHE", "0").strip().lower() in ("1", "true", "yes", "on")
+COND_DISK_CACHE_DIR = os.environ.get("AK_COND_DISK_CACHE_DIR", "")
+COND_DISK_CACHE_MAX_MB = float(os.environ.get("AK_COND_DISK_CACHE_MAX_MB", "2048"))
+COND_DISK_SUFFIX = ".safetensors"
+COND_DISK_FORMAT = "ak_cond_v1"
+
+
+def normalize_text(text):
+    if text is None:
+        return ""
+    if not isinstance(text, str):
+        text = str(text)
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def tensor_nbytes(t):
+    try:
+        return int(t.numel()) * int(t.element_size())
+    except Exception:
+        return 0
+
+
+# All CondLRU instances, so entries can be dropped when their owner is collected.
+_all_caches = weakref.WeakSet()
+_tracked_owners = set()
+
+
+def _release_owner(owner_id):
+    # Runs from the garbage collector, possibly in the middle of a cache
+    # operation: only queue the drop, caches apply it on their next access.
+    _tracked_owners.discard(owner_id)
+    for cache in list(_all_caches):
+        cache._released.append(owner_id)
+
+
+def track_owner(obj):
+    """Return id(obj) for use as the first element of a cache key.
+
+    Entries keyed by that id are dropped from every CondLRU as soon as obj is
+    garbage collected, so a reused id() never returns another model's data.
+    """
+    owner_id = id(obj)
+    if owner_id in _tracked_owners:
+        return owner_id
+    try:
+        weakref.finalize(obj, _release_owner, owner_id)
+    except TypeError:
+        # Not weak-referenceable: nothing to track, behave like a plain id().
+        return owner_id
+    _tracked_owners.add(owner_id)
+    return owner_id
+
+
+def _clip_base_model(clip):
+    inner = getattr(clip, "cond_stage_model", None)
+    if inner is None:
+        inner = getattr(clip, "clip", None) or getattr(clip, "model", None)
+    return inner if inner is not None else clip
+
+
+def _hash_patch_value(obj, h, depth=0):
+    if hasattr(obj, "shape") and hasattr(obj, "dtype"):
+        h.update(repr((tuple(obj.shape), str(obj.dtype))).encode("ascii"))
+        try:
+            probe = obj.detach().reshape(-1)[:8].float().cpu().tolist()
+        except Exception:
+            probe = id(obj)
+        h.update(repr(probe).encode("ascii"))
+    elif obj is None or isinstance(obj, (str, int, float, bool)):
+        h.update(repr(obj).encode("utf-8", errors="backslashreplace"))
+    elif depth > 6:
+        h.update(b"...")
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"(")
+        for x in obj:
+            _hash_patch_value(x, h, depth + 1)
+        h.update(b")")
+    elif isinstance(obj, dict):
+        h.update(b"{")
+        for k in sorted(obj, key=str):
+            h.update(str(k).encode("utf-8", errors="backslashreplace"))
+            _hash_patch_value(obj[k], h, depth + 1)
+        h.update(b"}")
+    elif callable(obj) and not hasattr(obj, "weights"):
+        h.update(getattr(obj, "__qualname__", type(obj).__name__).encode("utf-8"))
+    else:
+        # Weight adapters (LoRA, LoHa, ...) keep their tensors in .weights.
+        h.update(type(obj).__name__.encode("utf-8"))
+        weights = getattr(obj, "weights", None)
+        _hash_patch_value(weights if weights is not None else id(obj), h, depth + 1)
+
+
+_patch_fp_by_patcher = weakref.WeakKeyDictionary()
+
+
+def patches_fingerprint(patcher):
+    """Fingerprint of the weight patches (LoRA and strengths) on a ModelPatcher.
+
+    Patch tensors are identified by shape, dtype and a few leading values,
+    so reloading the same LoRA gives the same fingerprint. Memoized per
+    patcher until its patches_uuid changes.
+    """
+    patches = getattr(patcher, "patches", None) if patcher is not None else None
+    if not patches:
+        return ""
+    uuid = getattr(patcher, "patches_uuid", None)
+    try:
+        memo = _patch_fp_by_patcher.get(patcher)
+    except TypeError:
+        memo = None
+    if memo is not None and uuid is not None and memo[0] == uuid:
+        return memo[1]
+
+    h = hashlib.sha256()
+    for name in sorted(patches.keys(), key=str):
+        h.update(str(name).encode("utf-8", errors="backslashreplace"))
+        _hash_patch_value(patches[name], h)
+    fp = h.hexdigest()[:32]
+
+    if uuid is not None:
+        try:
+            _patch_fp_by_patcher[patcher] = (uuid, fp)
+        except TypeError:
+            pass
+    return fp
+
+
+def clip_variant(clip):
+    """Everything besides the base weights that changes a CLIP's output:
+    applied patches, clip skip layer and tokenizer options."""
+    options = getattr(clip, "tokenizer_options", None)
+    return (
+        patches_fingerprint(getattr(clip, "patcher", None)),
+        getattr(clip, "layer_idx", None),
+        repr(sorted(options.items())) if isinstance(options, dict) and options else "",
+    )
+
+
+def clip_cache_key(clip):
+    """Cache key prefix for a CLIP: (owner id of the base model, variant).
+
+    Clones made by LoRA loaders share the base model, so every LoRA variant
+    (and the plain model) keeps its own entries and they survive toggling a
+    LoRA off and on. Entries go away when the base model is collected.
+    """
+    return (track_owner(_clip_base_model(clip)), clip_variant(clip))
+
+
+# One byte budget (AK_COND_CACHE_MAX_MB) shared by every CondLRU. A tensor
+# held by several caches (the hash cache holds the text cache's tensors) is
+# counted once. Over budget, the least recently used entry of any cache goes.
+# All caches share _budget_lock.
+_budget_lock = threading.RLock()
+_budget_max_bytes = int(COND_CACHE_MAX_MB * 1024 * 1024)
+_budget_bytes = 0
+_tensor_refs = {}  # id(tensor) -> [entries holding it, nbytes]
+_budget_lru = OrderedDict()  # (id(cache), key) -> weakref to cache
+
+
+def _entry_tensors(value, found=None, depth=0):
+    """{id: nbytes} of the tensors in a cache value (conditioning, chunk entry)."""
+    if found is None:
+        found = {}
+    if hasattr(value, "element_size") and hasattr(value, "numel"):
+        found.setdefault(id(value), tensor_nbytes(value))
+    elif depth < 4 and isinstance(value, (dict, list, tuple)):
+        for item in (value.values() if isinstance(value, dict) else value):
+            _entry_tensors(item, found, depth + 1)
+    return found
+
+
+def _retain(tensors):
+    global _budget_bytes
+    for tid, nbytes in tensors.items():
+        ref = _tensor_refs.get(tid)
+        if ref is None:
+            _tensor_refs[tid] = [1, nbytes]
+            _budget_bytes += nbytes
+        else:
+            ref[0] += 1
+
+
+def _release(tensors):
+    global _budget_bytes
+    for tid in tensors:
+        ref = _tensor_refs.get(tid)
+        if ref is None:
+            continue
+        ref[0] -= 1
+        if ref[0] <= 0:
+            del _tensor_refs[tid]
+            _budget_bytes -= ref[1]
+
+
+def _evict_budget():
+    while _budget_max_bytes and _budget_bytes > _budget_max_bytes and _budget_lru:
+        (_, key), ref = next(iter(_budget_lru.items()))
+        cache = ref()
+        if cache is None or key not in cache._data:
+            _budget_lru.popitem(last=False)
+            continue
+        cache._remove(key)
+        cache.evictions += 1
+
+
+def set_budget_mb(max_mb):
+    """Change the shared byte budget of all conditioning caches (0 = no limit)."""
+    global _budget_max_bytes
+    with _budget_lock:
+        _budget_max_bytes = int(float(max_mb) * 1024 * 1024)
+        _evict_budget()
+
+
+def budget_info():
+    with _budget_lock:
+        return {"bytes": _budget_bytes, "max_bytes": _budget_max_bytes, "tensors": len(_tensor_refs)}
+
+
+class CondLRU:
+    """Thread-safe bounded LRU keyed by tuples whose first element is an
+    owner id (see track_owner).
+
+    Each cache has its own entry limit; bytes count against the budget
+    shared by all caches (see set_budget_mb). A limit of 0 disables it.
+    """
+
+    def __init__(self, name="", max_entries=COND_CACHE_MAX_ENTRIES):
+        self.name = name
+        self._data = OrderedDict()  # key -> (value, nbytes, {tensor id: nbytes})
+        self._lock = _budget_lock
+        self._ref = weakref.ref(self)
+        self._released = []
+        self.max_entries = int(max_entries)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        _all_caches.add(self)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            self._drop_released()
+            return key in self._data
+
+    def configure(self, max_entries=None):
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = int(max_entries)
+            self._evict()
+
+    def peek(self, key):
+        """Like get() but without touching LRU order or hit/miss counters."""
+        with self._lock:
+            self._drop_released()
+            entry = self._data.get(key)
+            return None if entry is None else entry[0]
+
+    def get(self, key):
+        with self._lock:
+            self._drop_released()
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            _budget_lru.move_to_end((id(self), key))
+            return entry[0]
+
+    def put(self, key, value):
+        tensors = _entry_tensors(value)
+        nbytes = sum(tensors.values())
+        with self._lock:
+            self._drop_released()
+            self._remove(key)
+            if _budget_max_bytes and nbytes > _budget_max_bytes:
+                # Would evict everything else and still not fit.
+                return
+            self._data[key] = (value, nbytes, tensors)
+            self.bytes += nbytes
+            _retain(tensors)
+            _budget_lru[(id(self), key)] = self._ref
+            self._evict()
+            _evict_budget()
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._remove(key)
+            return None if entry is None else entry[0]
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return None
+        self.bytes -= entry[1]
+        _release(entry[2])
+        _budget_lru.pop((id(self), key), None)
+        return entry
+
+    def drop_owner(self, owner_id):
+        with self._lock:
+            for key in [k for k in self._data if isinstance(k, tuple) and k and k[0] == owner_id]:
+                self._remove(key)
+
+    def _drop_released(self):
+        while self._released:
+            self.drop_owner(self._released.pop())
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._data):
+                self._remove(key)
+            self._released.clear()
+
+    def info(self):
+        with self._lock:
+            self._drop_released()
+            return {
+                "entries": len(self._data),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def _evict(self):
+        while self._data and self.max_entries and len(self._data) > self.max_entries:
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+
+# ---------------------------------------------------------------------------
+# Single-flight: identical encodes running at the same time are done once
+# ---------------------------------------------------------------------------
+
+class _Flight:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def begin_flight(key):
+    """Join or start the in-flight computation for key.
+
+    Returns (flight, leader). The leader must call end_flight; other callers
+    call wait_flight to get the leader's result.
+    """
+    with _inflight_lock:
+        flight = _inflight.get(key)
+        if flight is not None:
+            return flight, False
+        flight = _Flight()
+        _inflight[key] = flight
+        return flight, True
+
+
+def end_flight(key, flight, result=None, error=None):
+    flight.result = result
+    flight.error = error
+    with _inflight_lock:
+        if _inflight.get(key) is flight:
+            del _inflight[key]
+    flight.event.set()
+
+
+def wait_flight(flight):
+    flight.event.wait()
+    if flight.error is not None:
+        raise flight.error
+    return flight.result
+
+
+def single_flight(key, fn):
+    """Run fn() once for all concurrent callers using the same key.
+
+    Entries only live while the computation runs; afterwards the caches
+    serve the result, so the table never holds more than the encodes of
+    the prompt(s) currently executing.
+    """
+    flight, leader = begin_flight(key)
+    if not leader:
+        return wait_flight(flight)
+    try:
+        result = fn()
+    except BaseException as e:
+        end_flight(key, flight, error=e)
+        raise
+    end_flight(key, flight, result=result)
+    return result
+
+
+def cache_info():
+    """Size and limits of every live conditioning cache, by cache name."""
+    return {cache.name or str(id(cache)): cache.info() for cache in list(_all_caches)}
+
+
+def clear_caches():
+    for cache in list(_all_caches):
+        cache.clear()
+
+
+# Encoder timing per node: name -> {"calls", "texts", "seconds"}
+_encode_stats = {}
+
+
+@contextmanager
+def encode_timer(name, texts=1):
+    """Time an encode_from_tokens call (or batch of `texts` prompts) for cache_stats()."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        st = _encode_stats.setdefault(name, {"calls": 0, "texts": 0, "seconds": 0.0})
+        st["calls"] += 1
+        st["texts"] += texts
+        st["seconds"] += time.perf_counter() - t0
+
+
+def cache_stats():
+    """Counters for all conditioning caches, the disk tier and encode times."""
+    caches = cache_info()
+    store = get_disk_store()
+    return {
+        "caches": caches,
+        # Shared tensors counted once; per-cache "bytes" count them in each cache.
+        "bytes_held": budget_info()["bytes"],
+        "budget": budget_info(),
+        "disk": store.info() if store is not None else None,
+        "encode": {k: dict(v) for k, v in _encode_stats.items()},
+    }
+
+
+def reset_stats():
+    for cache in list(_all_caches):
+        cache.reset_stats()
+    store = get_disk_store()
+    if store is not None:
+        store.reset_stats()
+    _encode_stats.clear()
+
+
+# ---------------------------------------------------------------------------
+# Disk tier
+# ---------------------------------------------------------------------------
+
+_weights_fp_by_model = weakref.WeakKeyDictionary()
+
+
+def _weights_fingerprint(model, backup=None):
+    """Stable fingerprint of a text encoder's weights: names, shapes, dtypes
+    and a few leading values of every tensor. Computed once per model object.
+
+    ComfyUI patches LoRA weights into the model in place and keeps the
+    original tensors in the patcher's `backup`; those are used where present,
+    so the fingerprint is the one of the unpatched checkpoint whatever was
+    loaded first.
+    """
+    try:
+        cached = _weights_fp_by_model.get(model)
+    except TypeError:
+        cached = None
+    if cached is not None:
+        return cached
+
+    h = hashlib.sha256()
+    try:
+        sd = model.state_dict()
+        backup = dict(backup) if backup else {}
+        for name in sorted(sd.keys()):
+            t = sd[name]
+            original = backup.get(name)
+            if original is not None:
+                # Newer ComfyUI stores (weight, inplace_update) tuples.
+                t = getattr(original, "weight", original)
+            h.update(name.encode("utf-8"))
+            h.update(repr((tuple(t.shape), str(t.dtype))).encode("ascii"))
+            probe = t.detach().reshape(-1)[:8].float().cpu().tolist()
+            h.update(repr(probe).encode("ascii"))
+    except Exception:
+        return None
+
+    fp = h.hexdigest()
+    try:
+        _weights_fp_by_model[model] = fp
+    except TypeError:
+        pass
+    return fp
+
+
+def clip_disk_fingerprint(clip):
+    """Fingerprint identifying a CLIP's encoder output across restarts, or None."""
+    model = getattr(clip, "cond_stage_model", None)
+    if model is None:
+        return None
+    patcher = getattr(clip, "patcher", None)
+    fp = _weights_fingerprint(model, getattr(patcher, "backup", None))
+    if fp is None:
+        return None
+    return f"{fp}|{clip_variant(clip)!r}"
+
+
+class CondDiskStore:
+    """Conditioning stored as one safetensors file per entry, LRU-evicted by mtime."""
+
+    def __init__(self, directory, max_mb=COND_DISK_CACHE_MAX_MB):
+        self.directory = directory
+        self.max_bytes = int(float(max_mb) * 1024 * 1024)
+        self._files = None  # name -> [size, mtime]
+        self._lock = threading.RLock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key_for(self, clip, text):
+        fp = clip_disk_fingerprint(clip)
+        if fp is None:
+            return None
+        h = hashlib.sha256()
+        h.update(fp.encode("utf-8"))
+        h.update(b"\0")
+        h.update(text.encode("utf-8", errors="surrogatepass"))
+        return h.hexdigest()[:40]
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + COND_DISK_SUFFIX)
+
+    def _scan(self):
+        if self._files is not None:
+            return
+        self._files = {}
+        self.bytes = 0
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for fn in os.listdir(self.directory):
+                if not fn.endswith(COND_DISK_SUFFIX):
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.directory, fn))
+                except OSError:
+                    continue
+                self._files[fn] = [st.st_size, st.st_mtime]
+                self.bytes += st.st_size
+        except OSError:
+            pass
+
+    def load(self, key):
+        with self._lock:
+            return self._load_unlocked(key)
+
+    def _load_unlocked(self, key):
+        from safetensors import safe_open
+
+        self._scan()
+        fn = key + COND_DISK_SUFFIX
+        if fn not in self._files:
+            self.misses += 1
+            return None
+        path = self._path(key)
+        try:
+            with safe_open(path, framework="pt", device="cpu") as f:
+                meta = f.metadata() or {}
+                if meta.get("format") != COND_DISK_FORMAT:
+                    return None
+                cond = f.get_tensor("cond")
+                pooled = f.get_tensor("pooled") if "pooled" in f.keys() else None
+            os.utime(path)
+            self._files[fn][1] = os.stat(path).st_mtime
+        except Exception:
+            self._forget(fn)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [[cond, {"pooled_output": pooled}]]
+
+    def save(self, key, conditioning):
+        with self._lock:
+            return self._save_unlocked(key, conditioning)
+
+    def _save_unlocked(self, key, conditioning):
+        from safetensors.torch import save_file
+
+        self._scan()
+        try:
+            cond, data = conditioning[0][0], conditioning[0][1]
+            tensors = {"cond": cond.detach().cpu().contiguous()}
+            pooled = data.get("pooled_output") if isinstance(data, dict) else None
+            if pooled is not None:
+                tensors["pooled"] = pooled.detach().cpu().contiguous()
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(key)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            save_file(tensors, tmp, metadata={"format": COND_DISK_FORMAT})
+            os.replace(tmp, path)
+            st = os.stat(path)
+        except Exception:
+            return
+
+        fn = key + COND_DISK_SUFFIX
+        self._forget(fn)
+        self._files[fn] = [st.st_size, st.st_mtime]
+        self.bytes += st.st_size
+        self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._scan()
+            for fn in list(self._files.keys()):
+                self._remove(fn)
+
+    def _forget(self, fn):
+        entry = self._files.pop(fn, None)
+        if entry is not None:
+            self.bytes -= entry[0]
+
+    def _remove(self, fn):
+        self._forget(fn)
+        try:
+            os.remove(os.path.join(self.directory, fn))
+        except OSError:
+            pass
+
+    def _evict(self):
+        if not self.max_bytes or self.bytes <= self.max_bytes:
+            return
+        for fn, _ in sorted(self._files.items(), key=lambda kv: kv[1][1]):
+            if self.bytes <= self.max_bytes:
+                break
+            self._remove(fn)
+            self.evictions += 1
+
+    def info(self):
+        with self._lock:
+            self._scan()
+            return {
+                "directory": self.directory,
+                "entries": len(self._files),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+def _default_disk_dir():
+    if COND_DISK_CACHE_DIR:
+        return COND_DISK_CACHE_DIR
+    import folder_paths
+
+    return os.path.join(folder_paths.get_user_directory(), "ak_cond_cache")
+
+
+_disk_store = None
+_disk_store_lock = threading.Lock()
+
+
+def get_disk_store():
+    """Shared CondDiskStore, or None when the disk tier is disabled."""
+    global _disk_store
+    if not COND_DISK_CACHE_ENABLED:
+        return None
+    with _disk_store_lock:
+        if _disk_store is None:
+            try:
+                _disk_store = CondDiskStore(_default_disk_dir())
+            except Exception:
+                return None
+    return _disk_store
+
+
+def disk_load(clip, text):
+    store = get_disk_store()
+    if store is None:
+        return None
+    key = store.key_for(clip, text)
+    if key is None:
+        return None
+    return store.load(key)
+
+
+def disk_save(clip, text, conditioning):
+    store = get_disk_store()
+    if store is None:
+        return
+    key = store.key_for(clip, text)
+    if key is None:
+        return
+    store.save(key, conditioning)
+
+
+# ---------------------------------------------------------------------------
+# HTTP route
+# ---------------------------------------------------------------------------
+
+def server_routes():
+    """(aiohttp.web, PromptServer routes), or None outside a running ComfyUI."""
+    try:
+        from aiohttp import web
+        from server import PromptServer
+    except ImportError:
+        return None
+    instance = getattr(PromptServer, "instance", None)
+    if instance is None:
+        return None
+    return web, instance.routes
+
+
+def _register_routes():
+    server = server_routes()
+    if server is None:
+        return
+    web, routes = server
+
+    @routes.get("/ak/cond_cache/stats")
+    async def _cond_cache_stats(request):
+        return web.json_response(cache_stats())
+
+    @routes.post("/ak/cond_cache/stats/reset")
+    async def _cond_cache_stats_reset(request):
+        # Returns the counters as they were before the reset.
+        stats = cache_stats()
+        reset_stats()
+        return web.json_response(stats)
+
+
+_register_routes()
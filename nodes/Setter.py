@@ -1,80 +1,420 @@
-import sys, types, bisect
+import os, sys, types, bisect, threading, weakref
+from collections import OrderedDict
+
+from .CondCache import tensor_nbytes, server_routes
 
 _STORE_KEY = "ak_var_nodes_store"
 
+# Bytes of Setter values the store may keep alive by itself. Values are always
+# tracked weakly; up to this many bytes (most recently set first) are also
+# held strongly. 0 = never pin anything.
+VAR_STORE_MAX_MB = float(os.environ.get("AK_VAR_STORE_MAX_MB", "0"))
+# Prompt scopes kept at most (the newest one always survives).
+VAR_STORE_MAX_SCOPES = int(os.environ.get("AK_VAR_STORE_MAX_SCOPES", "4"))
+
 class AnyType(str):
     def __ne__(self, __value: object) -> bool:
         return False
 
 ANY_TYPE = AnyType("*")
 
+# Store layout (kept in sys.modules so it survives module reloads):
+#   st.scopes:  prompt key -> scope, oldest first
+#   scope.namespaces: subgraph id ("" = top level) -> namespace
+#   namespace: allowed_ids_by_name, values_by_name, names_sorted,
+#              last_name_by_setter_id, bytes_by_name
+# Setters of different prompts, or of different subgraphs of one prompt,
+# never share a namespace.
+# st.lock guards all of it: prompts are scoped on the server thread (prompt
+# handler, /ak/vars routes) while Setters run on the executor thread.
+
 def _get_store():
     st = sys.modules.get(_STORE_KEY)
-    if st is None:
+    if st is None or not hasattr(st, "scopes"):
+        # (An older, process-global store is simply replaced.)
         st = types.SimpleNamespace(
-            last_prompt_obj_id=None,
-            allowed_ids_by_name={},
-            values_by_name={},
-            names_sorted=[],
-            last_name_by_setter_id={}
+            scopes=OrderedDict(),
+            latest_key=None,
+            pinned=OrderedDict(),
+            pinned_bytes=0,
+            names_version=0,
+            lock=threading.RLock(),
         )
         sys.modules[_STORE_KEY] = st
-    if not hasattr(st, "last_name_by_setter_id"):
-        st.last_name_by_setter_id = {}
+    if not hasattr(st, "names_version"):
+        st.names_version = 0
+    if not hasattr(st, "lock"):
+        st.lock = threading.RLock()
     return st
 
-def _rebuild_from_prompt(st, prompt):
-    st.allowed_ids_by_name.clear()
-    st.names_sorted.clear()
-    valid_names = set()
+def _new_namespace():
+    return types.SimpleNamespace(
+        allowed_ids_by_name={},
+        values_by_name={},
+        names_sorted=[],
+        last_name_by_setter_id={},
+        bytes_by_name={},
+    )
+
+def _subgraph_of(node_id):
+    # Nodes inside a (expanded) subgraph have ids like "12:5".
+    sid = str(node_id)
+    i = sid.rfind(":")
+    return sid[:i] if i >= 0 else ""
+
+def _value_nbytes(value, seen=None, depth=0):
+    """Bytes of the tensors in a value (IMAGE, LATENT, CONDITIONING, ...).
+
+    Models are sized with model_size() when they have it (ModelPatcher).
+    """
+    if seen is None:
+        seen = set()
+    if hasattr(value, "element_size") and hasattr(value, "numel"):
+        if id(value) in seen:
+            return 0
+        seen.add(id(value))
+        return tensor_nbytes(value)
+    if isinstance(value, dict):
+        items = value.values()
+    elif isinstance(value, (list, tuple)):
+        items = value
+    else:
+        size = getattr(value, "model_size", None)
+        if callable(size) and id(value) not in seen:
+            seen.add(id(value))
+            try:
+                return int(size())
+            except Exception:
+                return 0
+        return 0
+    if depth >= 6:
+        return 0
+    return sum(_value_nbytes(v, seen, depth + 1) for v in items)
+
+_DEAD = object()
+
+class _WeakValue:
+    """Weak view of a Setter value.
+
+    Tensors and model objects are held through weak references; the dicts,
+    lists and tuples around them (LATENT, CONDITIONING) are mirrored so the
+    value can be rebuilt while everything in it is still alive elsewhere.
+    """
+
+    __slots__ = ("_tree",)
+
+    def __init__(self, tree):
+        self._tree = tree
+
+    @classmethod
+    def wrap(cls, value):
+        return cls(cls._weaken(value, 0))
+
+    @classmethod
+    def _weaken(cls, v, depth):
+        if v is None or isinstance(v, (str, bytes, int, float, bool)):
+            return ("V", v)
+        t = type(v)
+        if depth < 6:
+            if t is dict:
+                return ("D", [(k, cls._weaken(x, depth + 1)) for k, x in v.items()])
+            if t is list or t is tuple:
+                return ("L" if t is list else "T", [cls._weaken(x, depth + 1) for x in v])
+        try:
+            return ("W", weakref.ref(v))
+        except TypeError:
+            return ("V", v)
+
+    @classmethod
+    def _resolve(cls, node):
+        kind, data = node
+        if kind == "V":
+            return data
+        if kind == "W":
+            v = data()
+            return _DEAD if v is None else v
+        if kind == "D":
+            out = {}
+            for k, x in data:
+                v = cls._resolve(x)
+                if v is _DEAD:
+                    return _DEAD
+                out[k] = v
+            return out
+        out = []
+        for x in data:
+            v = cls._resolve(x)
+            if v is _DEAD:
+                return _DEAD
+            out.append(v)
+        return out if kind == "L" else tuple(out)
+
+    def get(self):
+        """The value, or None once any part of it has been freed."""
+        v = self._resolve(self._tree)
+        return None if v is _DEAD else v
+
+def _store_value(st, ns, name, value):
+    _unpin(st, ns, name)
+    ns.bytes_by_name.pop(name, None)
+    if value is None:
+        ns.values_by_name[name] = None
+        return
+
+    cap = int(VAR_STORE_MAX_MB * 1024 * 1024)
+    if cap <= 0:
+        # Weak-only store: sizes are computed when a report asks for them.
+        ns.values_by_name[name] = _WeakValue.wrap(value)
+        return
+
+    nbytes = _value_nbytes(value)
+    ns.bytes_by_name[name] = nbytes
+    if nbytes > cap:
+        ns.values_by_name[name] = _WeakValue.wrap(value)
+        return
+
+    ns.values_by_name[name] = value
+    st.pinned[(id(ns), name)] = (ns, nbytes)
+    st.pinned_bytes += nbytes
+    # Over the cap: demote the oldest pinned values to weak references.
+    while st.pinned_bytes > cap and st.pinned:
+        (_, old), (old_ns, _) = next(iter(st.pinned.items()))
+        v = old_ns.values_by_name.get(old)
+        _unpin(st, old_ns, old)
+        old_ns.values_by_name[old] = None if v is None else _WeakValue.wrap(v)
+
+def _unpin(st, ns, name):
+    entry = st.pinned.pop((id(ns), name), None)
+    if entry is not None:
+        st.pinned_bytes -= entry[1]
+
+def _drop_value(st, ns, name):
+    _unpin(st, ns, name)
+    ns.values_by_name.pop(name, None)
+    ns.bytes_by_name.pop(name, None)
+
+def _drop_scope(st, key):
+    scope = st.scopes.pop(key, None)
+    if scope is None:
+        return
+    for ns in scope.namespaces.values():
+        for name in list(ns.values_by_name):
+            _unpin(st, ns, name)
+
+def _latest_scope(st):
+    if st.latest_key is None:
+        return None
+    return st.scopes.get(st.latest_key)
+
+def get_value(name, subgraph=""):
+    """Value of a variable in the most recent prompt, or None if unset or freed."""
+    st = _get_store()
+    with st.lock:
+        scope = _latest_scope(st)
+        ns = scope.namespaces.get(subgraph) if scope is not None else None
+        v = ns.values_by_name.get(name) if ns is not None else None
+    if isinstance(v, _WeakValue):
+        return v.get()
+    return v
+
+def store_report():
+    """Which variables the store tracks and how much memory they hold."""
+    st = _get_store()
+    rows = []
+    seen = set()
+    with st.lock:
+        for key, scope in reversed(st.scopes.items()):
+            for sub, ns in scope.namespaces.items():
+                for name in ns.names_sorted:
+                    v = ns.values_by_name.get(name)
+                    if isinstance(v, _WeakValue):
+                        v = v.get()
+                        held = "weak" if v is not None else "released"
+                    else:
+                        held = "empty" if v is None else "strong"
+                    rows.append({
+                        "prompt": scope.label,
+                        "subgraph": sub,
+                        "name": name,
+                        "setter_id": ns.allowed_ids_by_name.get(name),
+                        # Tensors shared by several variables are counted once.
+                        "bytes": 0 if v is None else _value_nbytes(v, seen),
+                        "held": held,
+                    })
+        scopes = [s.label for s in st.scopes.values()]
+        pinned_bytes = st.pinned_bytes
+    rows.sort(key=lambda r: r["bytes"], reverse=True)
+    return {
+        "scopes": scopes,
+        "pinned_bytes": pinned_bytes,
+        "max_pinned_bytes": int(VAR_STORE_MAX_MB * 1024 * 1024),
+        "vars": rows,
+    }
+
+def names_index():
+    """Setter names of the most recent prompt, with a version that changes
+    whenever they do. "names" is the top level, "subgraphs" the rest."""
+    st = _get_store()
+    with st.lock:
+        scope = _latest_scope(st)
+        subgraphs = {}
+        if scope is not None:
+            subgraphs = {sub: list(ns.names_sorted) for sub, ns in scope.namespaces.items()}
+        version = st.names_version
+    return {
+        "version": version,
+        "names": subgraphs.pop("", []),
+        "subgraphs": subgraphs,
+    }
+
+def _names_signature(scope):
+    if scope is None:
+        return {}
+    return {sub: ns.names_sorted for sub, ns in scope.namespaces.items() if ns.names_sorted}
+
+def _server_instance():
+    srv = sys.modules.get("server")
+    if srv is None:
+        return None
+    try:
+        return srv.PromptServer.instance
+    except Exception:
+        return None
+
+def _current_prompt_id():
+    # Set by ComfyUI's executor for the prompt being run.
+    return getattr(_server_instance(), "last_prompt_id", None)
 
+def _active_prompt_ids():
+    """prompt_ids running or waiting in ComfyUI's queue, or None if unknown."""
+    queue = getattr(_server_instance(), "prompt_queue", None)
+    get = getattr(queue, "get_current_queue_volatile", None)
+    if get is None:
+        return None
     try:
-        if isinstance(prompt, dict):
-            for node_id, node in prompt.items():
-                if not isinstance(node, dict):
-                    continue
-                if node.get("class_type") != "Setter":
-                    continue
-                inputs = node.get("inputs") or {}
-                name = inputs.get("var_name", "")
-                if name is None:
-                    name = ""
-                if not isinstance(name, str):
-                    name = str(name)
-                name = name.strip()
-                if not name:
-                    continue
-
-                sid = str(node_id)
-                old_name = st.last_name_by_setter_id.get(sid)
-
-                if old_name and old_name != name:
-                    if name not in st.values_by_name:
-                        v = st.values_by_name.get(old_name, None)
-                        if v is not None:
-                            st.values_by_name[name] = v
-                    if old_name in st.values_by_name and old_name != name:
-                        del st.values_by_name[old_name]
-
-                st.last_name_by_setter_id[sid] = name
-
-                valid_names.add(name)
-                if name not in st.allowed_ids_by_name:
-                    st.allowed_ids_by_name[name] = sid
-                    if name not in st.values_by_name:
-                        st.values_by_name[name] = None
-                    bisect.insort(st.names_sorted, name)
-
-        for k in list(st.values_by_name.keys()):
-            if k not in valid_names:
-                del st.values_by_name[k]
-
-        for sid, nm in list(st.last_name_by_setter_id.items()):
-            if nm not in valid_names:
-                del st.last_name_by_setter_id[sid]
+        running, pending = get()
+        return {item[1] for item in list(running) + list(pending)}
     except Exception:
-        st.allowed_ids_by_name.clear()
-        st.names_sorted.clear()
+        return None
+
+def _prompt_key(prompt):
+    """Identifies the queued prompt: its prompt_id, else the prompt dict itself.
+
+    For the dict fallback the scope keeps the dict alive, so its id() cannot
+    be reused by a later prompt while the scope exists.
+    """
+    pid = _current_prompt_id()
+    if pid is not None:
+        return ("id", pid)
+    return ("obj", id(prompt))
+
+def _scan_setters(prompt):
+    """{subgraph: {setter node id: var_name}} for every named Setter in the prompt."""
+    by_subgraph = {}
+    if not isinstance(prompt, dict):
+        return by_subgraph
+    for node_id, node in prompt.items():
+        if not isinstance(node, dict) or node.get("class_type") != "Setter":
+            continue
+        inputs = node.get("inputs") or {}
+        name = inputs.get("var_name", "")
+        if name is None:
+            name = ""
+        if not isinstance(name, str):
+            name = str(name)
+        name = name.strip()
+        if name:
+            sid = str(node_id)
+            by_subgraph.setdefault(_subgraph_of(sid), {})[sid] = name
+    return by_subgraph
+
+def _rebuild_namespace(ns, setters, prev):
+    """Index `setters` into the empty namespace `ns`, diffing against `prev`.
+
+    Values from the previous prompt are carried over (as weak views); a
+    renamed Setter keeps its value under the new name until it runs.
+    """
+    allowed = {}
+    for sid, name in setters.items():
+        allowed.setdefault(name, sid)
+
+    if prev is not None:
+        old_names = prev.last_name_by_setter_id
+        for name in allowed:
+            v = prev.values_by_name.get(name)
+            if v is not None:
+                ns.values_by_name[name] = v if isinstance(v, _WeakValue) else _WeakValue.wrap(v)
+        for sid, name in setters.items():
+            old_name = old_names.get(sid)
+            if old_name and old_name != name and ns.values_by_name.get(name) is None:
+                v = prev.values_by_name.get(old_name)
+                if v is not None:
+                    ns.values_by_name[name] = v if isinstance(v, _WeakValue) else _WeakValue.wrap(v)
+
+    for name in allowed:
+        ns.values_by_name.setdefault(name, None)
+
+    if prev is not None and allowed.keys() == prev.allowed_ids_by_name.keys():
+        ns.names_sorted[:] = prev.names_sorted
+    else:
+        ns.names_sorted[:] = sorted(allowed)
+    ns.allowed_ids_by_name.update(allowed)
+    ns.last_name_by_setter_id = setters
+
+def _build_scope(st, key, prompt, label=None):
+    """Create the scope of a new prompt from its Setters (once per prompt)."""
+    try:
+        by_subgraph = _scan_setters(prompt)
+    except Exception:
+        by_subgraph = {}
+    # Read outside st.lock: the queue has its own lock.
+    active = _active_prompt_ids()
+
+    with st.lock:
+        prev = _latest_scope(st)
+        scope = types.SimpleNamespace(
+            key=key,
+            label=str(label if label is not None else key[1]),
+            prompt=prompt if key[0] == "obj" else None,
+            namespaces={},
+            snapshot_keys={},
+        )
+        for sub, setters in by_subgraph.items():
+            ns = _new_namespace()
+            _rebuild_namespace(ns, setters, prev.namespaces.get(sub) if prev is not None else None)
+            scope.namespaces[sub] = ns
+
+        if _names_signature(scope) != _names_signature(prev):
+            st.names_version += 1
+
+        _drop_scope(st, key)
+        st.scopes[key] = scope
+        st.latest_key = key
+        _prune_scopes(st, active)
+    return scope
+
+def _prune_scopes(st, active):
+    # ComfyUI has no hook for "prompt finished", so scopes of prompts that
+    # left the queue are dropped here, when the next prompt is scoped. Until
+    # then their pinned values stay alive (within AK_VAR_STORE_MAX_MB). The
+    # newest scope always stays as the base for the next prompt.
+    if active is not None:
+        for key in list(st.scopes):
+            if key != st.latest_key and key[0] == "id" and key[1] not in active:
+                _drop_scope(st, key)
+    while len(st.scopes) > max(1, VAR_STORE_MAX_SCOPES):
+        oldest = next(iter(st.scopes))
+        if oldest == st.latest_key:
+            break
+        _drop_scope(st, oldest)
+
+def _scope_for(st, prompt):
+    key = _prompt_key(prompt)
+    with st.lock:
+        scope = st.scopes.get(key)
+    if scope is None or (key[0] == "obj" and scope.prompt is not prompt):
+        scope = _build_scope(st, key, prompt)
+    return scope
 
 class Setter:
 
@@ -85,6 +425,11 @@ class Setter:
                 "obj": (ANY_TYPE,),
                 "var_name": ("STRING", {"default": ""}),
             },
+            "optional": {
+                # Save the value to disk and restore it, without running the
+                # upstream, while everything upstream stays the same.
+                "snapshot": ("BOOLEAN", {"default": False}),
+            },
             "hidden": {
                 "prompt": "PROMPT",
                 "unique_id": "UNIQUE_ID",
@@ -94,22 +439,16 @@ class Setter:
     RETURN_TYPES = (ANY_TYPE,)
     RETURN_NAMES = ("OUT",)
     FUNCTION = "set"
-    OUTPUT_NODE = True
+    # Not an output node: a Setter (and its upstream) only runs when
+    # something reads the variable.
+    OUTPUT_NODE = False
     CATEGORY = "AK/_testing_"
 
-    def set(self, obj, var_name, prompt=None, unique_id=None):
+    def set(self, obj, var_name, snapshot=False, prompt=None, unique_id=None):
         st = _get_store()
 
-        pid = None
-        try:
-            pid = id(prompt)
-        except Exception:
-            pid = None
-
-        if pid is not None and pid != st.last_prompt_obj_id:
-            st.last_prompt_obj_id = pid
-            _rebuild_from_prompt(st, prompt)
-
+        # The scope is built once per queued prompt; every other Setter in
+        # the same run only does dict lookups.
         if var_name is None:
             var_name = ""
         if not isinstance(var_name, str):
@@ -118,16 +457,60 @@ class Setter:
         if not name:
             raise Exception(f"[Setter {unique_id}] var_name is empty")
 
-        if name not in st.allowed_ids_by_name:
-            st.allowed_ids_by_name[name] = str(unique_id)
-            st.values_by_name[name] = None
-            bisect.insort(st.names_sorted, name)
-
+        scope = _scope_for(st, prompt)
+        sub = _subgraph_of(unique_id)
         # value = obj[0] if isinstance(obj, (list, tuple)) else obj
         value = obj
-        st.values_by_name[name] = value
+        with st.lock:
+            ns = scope.namespaces.get(sub)
+            if ns is None:
+                ns = scope.namespaces[sub] = _new_namespace()
+
+            if name not in ns.allowed_ids_by_name:
+                ns.allowed_ids_by_name[name] = str(unique_id)
+                ns.values_by_name[name] = None
+                bisect.insort(ns.names_sorted, name)
+                if scope.key == st.latest_key:
+                    st.names_version += 1
+
+            _store_value(st, ns, name, value)
+
+        if snapshot:
+            from . import VarSnapshot
+            # Keys come from the prompt as queued (before the Getter/Setter
+            # rewrite); without the prompt hook they are computed here.
+            key = scope.snapshot_keys.get(str(unique_id))
+            if key is None:
+                key = VarSnapshot.snapshot_key(prompt, unique_id)
+            VarSnapshot.save_snapshot(key, value)
         return (value,)
 
+_BOOT_ID = os.urandom(4).hex()
+
+def _register_routes():
+    server = server_routes()
+    if server is None:
+        return
+    web, routes = server
+
+    @routes.get("/ak/vars/store")
+    async def _vars_store(request):
+        return web.json_response(store_report())
+
+    @routes.get("/ak/vars/names")
+    async def _vars_names(request):
+        # The version is per process, so the ETag also carries the boot id.
+        index = names_index()
+        etag = f'"{_BOOT_ID}-{index["version"]}"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag in request.headers.get("If-None-Match", ""):
+            return web.Response(status=304, headers=headers)
+        return web.json_response(index, headers=headers)
+
+_register_routes()
+
+from . import VarCollapse  # registers the Getter/Setter prompt rewrite
+
 NODE_CLASS_MAPPINGS = {
     "Setter": Setter,
 }
@@ -0,0 +1,224 @@
+import logging
+import os
+import uuid
+
+from .Setter import _get_store, _build_scope
+from .VarSnapshot import apply_snapshots, is_link
+
+# Rewrites queued prompts so Getter/Setter cost nothing at run time: every
+# consumer of a Getter (or Setter) output is linked straight to the output
+# feeding the Setter, and the Getter/Setter nodes are removed. A Getter/Setter
+# stays when the source type would not validate against one of its consumers
+# (their "*" type is what let the link through). AK_VAR_COLLAPSE=0 turns it off.
+VAR_COLLAPSE_ENABLED = os.environ.get("AK_VAR_COLLAPSE", "1").strip().lower() not in ("0", "false", "no", "off")
+
+SETTER_CLASS = "Setter"
+GETTER_CLASS = "Getter"
+
+log = logging.getLogger(__name__)
+
+
+def _resolve_sources(prompt, keep=()):
+    """{var node id: [src_id, slot]} for every Setter/Getter that can be bypassed.
+
+    Follows Getter -> Setter -> (Getter -> Setter ...) chains to the first
+    real output. Nodes whose input is missing are left out, so they still run
+    and report their own error.
+    """
+    var_nodes = {}
+    for node_id, node in prompt.items():
+        if not isinstance(node, dict) or str(node_id) in keep:
+            continue
+        ct = node.get("class_type")
+        if ct == SETTER_CLASS:
+            var_nodes[str(node_id)] = (node.get("inputs") or {}).get("obj")
+        elif ct == GETTER_CLASS:
+            var_nodes[str(node_id)] = (node.get("inputs") or {}).get("inp")
+
+    sources = {}
+    for node_id in var_nodes:
+        chain = []
+        cur = node_id
+        src = None
+        while True:
+            if cur in sources:
+                src = sources[cur]
+                break
+            if cur in chain:
+                break  # cycle
+            chain.append(cur)
+            link = var_nodes.get(cur)
+            if not is_link(link):
+                break
+            up = str(link[0])
+            if up not in var_nodes:
+                src = [up, link[1]]
+                break
+            cur = up
+        if src is not None:
+            for n in chain:
+                sources[n] = src
+    return sources
+
+
+def _node_classes():
+    """ComfyUI's NODE_CLASS_MAPPINGS, or None outside ComfyUI."""
+    try:
+        import nodes
+    except ImportError:
+        return None
+    return getattr(nodes, "NODE_CLASS_MAPPINGS", None)
+
+
+def _fallback_validate_node_input(received_type, input_type):
+    # Same rule as ComfyUI's validate_node_input (non-strict).
+    if not received_type != input_type:
+        return True
+    if not isinstance(received_type, str) or not isinstance(input_type, str):
+        return False
+    received = set(t.strip() for t in received_type.split(","))
+    accepted = set(t.strip() for t in input_type.split(","))
+    return len(received & accepted) > 0
+
+
+try:
+    from comfy_execution.validation import validate_node_input as _validate_node_input
+except ImportError:
+    _validate_node_input = _fallback_validate_node_input
+
+
+def _output_type(classes, prompt, link):
+    node = prompt.get(str(link[0]))
+    cls = classes.get(node.get("class_type")) if isinstance(node, dict) else None
+    try:
+        return cls.RETURN_TYPES[link[1]]
+    except Exception:
+        return None
+
+
+def _input_type(classes, node, name, specs):
+    ct = node.get("class_type")
+    if ct not in specs:
+        # INPUT_TYPES() of loaders lists files, so call it once per class.
+        try:
+            specs[ct] = classes[ct].INPUT_TYPES()
+        except Exception:
+            specs[ct] = None
+    spec = specs[ct]
+    if not isinstance(spec, dict):
+        return None
+    for section in ("required", "optional"):
+        info = (spec.get(section) or {}).get(name)
+        if info:
+            # Combo inputs are declared as a list of choices.
+            return "COMBO" if isinstance(info[0], list) else info[0]
+    return None
+
+
+def _type_mismatches(prompt, sources, classes):
+    """Var node ids whose source output type fails validation for a consumer."""
+    bad = set()
+    specs = {}
+    for node in prompt.values():
+        if not isinstance(node, dict) or node.get("class_type") in (SETTER_CLASS, GETTER_CLASS):
+            continue  # var node inputs accept anything
+        for name, value in (node.get("inputs") or {}).items():
+            if not is_link(value):
+                continue
+            var_id = str(value[0])
+            src = sources.get(var_id)
+            if src is None or var_id in bad:
+                continue
+            received = _output_type(classes, prompt, src)
+            expected = _input_type(classes, node, name, specs)
+            if received is None or expected is None or not _validate_node_input(received, expected):
+                bad.add(var_id)
+    return bad
+
+
+def collapse_prompt(prompt, keep=(), classes=None):
+    """Bypass Getter/Setter nodes in place. Returns the ids of removed nodes.
+
+    Nodes in `keep` are treated as ordinary nodes (they stay and run). With
+    `classes` (NODE_CLASS_MAPPINGS), a Getter/Setter is only bypassed when
+    its source type validates against every input it feeds.
+    """
+    keep = set(keep)
+    while True:
+        sources = _resolve_sources(prompt, keep)
+        if not sources:
+            return []
+        if classes is None:
+            break
+        bad = _type_mismatches(prompt, sources, classes)
+        if not bad:
+            break
+        # Kept var nodes output "*", so consumers behind them are fine.
+        keep |= bad
+
+    for node in prompt.values():
+        if not isinstance(node, dict):
+            continue
+        inputs = node.get("inputs")
+        if not inputs:
+            continue
+        for name, value in inputs.items():
+            if is_link(value):
+                src = sources.get(str(value[0]))
+                if src is not None:
+                    inputs[name] = list(src)
+
+    removed = list(sources)
+    for node_id in removed:
+        prompt.pop(node_id, None)
+    return removed
+
+
+def on_prompt(json_data):
+    try:
+        prompt = json_data.get("prompt")
+        if not isinstance(prompt, dict):
+            return json_data
+
+        # Removed or pruned Setters never run, so the prompt's variable
+        # scope is built here, keyed by the prompt_id the executor will report.
+        prompt_id = json_data.setdefault("prompt_id", str(uuid.uuid4()))
+        st = _get_store()
+        scope = _build_scope(st, ("id", prompt_id), prompt)
+
+        # Snapshot Setters either become restore nodes or must run to save.
+        pending = apply_snapshots(prompt)
+        with st.lock:
+            scope.snapshot_keys.update(pending)
+
+        if not VAR_COLLAPSE_ENABLED:
+            return json_data
+
+        targets = json_data.get("partial_execution_targets")
+        if targets:
+            for t in targets:
+                node = prompt.get(str(t))
+                if isinstance(node, dict) and node.get("class_type") in (SETTER_CLASS, GETTER_CLASS):
+                    return json_data
+
+        classes = _node_classes()
+        if classes is None:
+            return json_data
+        collapse_prompt(prompt, keep=pending, classes=classes)
+    except Exception as e:
+        log.warning("[AK] Getter/Setter collapse skipped: %s", e)
+    return json_data
+
+
+def _register_prompt_handler():
+    try:
+        from server import PromptServer
+    except ImportError:
+        return
+    instance = getattr(PromptServer, "instance", None)
+    if instance is None or not hasattr(instance, "add_on_prompt_handler"):
+        return
+    instance.add_on_prompt_handler(on_prompt)
+
+
+_register_prompt_handler()
@@ -0,0 +1,296 @@
+# VarSnapshot.py
+# Opt-in Setter snapshots: a Setter with snapshot=True saves its value to a
+# safetensors file keyed by the fingerprint of everything upstream of it.
+# When a later prompt (also after a restart) has the same upstream, the
+# Setter is replaced by a restore node and the upstream chain is not run.
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from .CondCache import CondDiskStore, COND_DISK_SUFFIX
+
+VAR_SNAPSHOT_DIR = os.environ.get("AK_VAR_SNAPSHOT_DIR", "")
+VAR_SNAPSHOT_MAX_MB = float(os.environ.get("AK_VAR_SNAPSHOT_MAX_MB", "8192"))
+VAR_SNAPSHOT_FORMAT = "ak_var_v1"
+
+SETTER_CLASS = "Setter"
+RESTORE_CLASS = "SetterSnapshotRestore"
+
+log = logging.getLogger(__name__)
+
+
+# ---------------------------------------------------------------------------
+# Upstream fingerprint
+# ---------------------------------------------------------------------------
+
+def is_link(value):
+    """True for a prompt input that links to another node's output."""
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+
+
+def _node_signature(prompt, node_id, memo, stack):
+    """Hash of a node's class, constant inputs and (recursively) its upstream."""
+    node_id = str(node_id)
+    sig = memo.get(node_id)
+    if sig is not None:
+        return sig
+    node = prompt.get(node_id)
+    if not isinstance(node, dict) or node_id in stack:
+        return None
+    stack.add(node_id)
+    try:
+        parts = [node.get("class_type")]
+        for name, value in sorted((node.get("inputs") or {}).items()):
+            if is_link(value):
+                up = _node_signature(prompt, value[0], memo, stack)
+                if up is None:
+                    return None
+                parts.append((name, "L", up, value[1]))
+            else:
+                parts.append((name, "V", value))
+        data = json.dumps(parts, sort_keys=True, default=repr).encode("utf-8")
+    finally:
+        stack.discard(node_id)
+    sig = hashlib.sha256(data).hexdigest()
+    memo[node_id] = sig
+    return sig
+
+
+def snapshot_key(prompt, setter_id, memo=None):
+    """Key of the value fed into a Setter, or None when it cannot be fingerprinted."""
+    node = prompt.get(str(setter_id)) if isinstance(prompt, dict) else None
+    if not isinstance(node, dict):
+        return None
+    link = (node.get("inputs") or {}).get("obj")
+    if not is_link(link):
+        return None
+    up = _node_signature(prompt, link[0], {} if memo is None else memo, set())
+    if up is None:
+        return None
+    h = hashlib.sha256()
+    h.update(VAR_SNAPSHOT_FORMAT.encode("ascii"))
+    h.update(f"{up}:{link[1]}".encode("ascii"))
+    return h.hexdigest()[:40]
+
+
+# ---------------------------------------------------------------------------
+# Value <-> safetensors
+# ---------------------------------------------------------------------------
+
+def _flatten(value, tensors, ids, depth=0):
+    """JSON structure of a value; its tensors go into `tensors`.
+
+    Supports tensors and dicts/lists/tuples of tensors and JSON scalars
+    (IMAGE, MASK, LATENT, CONDITIONING). Anything else raises TypeError.
+    """
+    if hasattr(value, "detach") and hasattr(value, "numel"):
+        key = ids.get(id(value))
+        if key is None:
+            key = ids[id(value)] = f"t{len(ids)}"
+            tensors[key] = value.detach().cpu().contiguous()
+        return {"t": "tensor", "k": key}
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return {"t": "json", "v": value}
+    if depth >= 8:
+        raise TypeError("value nested too deeply")
+    if type(value) is dict:
+        out = {}
+        for k, v in value.items():
+            if not isinstance(k, str):
+                raise TypeError(f"non-string key {k!r}")
+            out[k] = _flatten(v, tensors, ids, depth + 1)
+        return {"t": "dict", "v": out}
+    if type(value) in (list, tuple):
+        return {
+            "t": "list" if type(value) is list else "tuple",
+            "v": [_flatten(v, tensors, ids, depth + 1) for v in value],
+        }
+    raise TypeError(f"cannot snapshot {type(value).__name__}")
+
+
+def _unflatten(node, tensors):
+    t = node["t"]
+    if t == "tensor":
+        return tensors[node["k"]]
+    if t == "json":
+        return node["v"]
+    if t == "dict":
+        return {k: _unflatten(v, tensors) for k, v in node["v"].items()}
+    items = [_unflatten(v, tensors) for v in node["v"]]
+    return items if t == "list" else tuple(items)
+
+
+class VarSnapshotStore(CondDiskStore):
+    """Setter values stored as one safetensors file per upstream fingerprint."""
+
+    def __init__(self, directory, max_mb=VAR_SNAPSHOT_MAX_MB):
+        super().__init__(directory, max_mb)
+
+    def has(self, key):
+        with self._lock:
+            self._scan()
+            return (key + COND_DISK_SUFFIX) in self._files
+
+    def _load_unlocked(self, key):
+        from safetensors import safe_open
+
+        self._scan()
+        fn = key + COND_DISK_SUFFIX
+        if fn not in self._files:
+            self.misses += 1
+            return None
+        path = self._path(key)
+        try:
+            # safe_open maps the file; tensors are read from the mapping.
+            with safe_open(path, framework="pt", device="cpu") as f:
+                meta = f.metadata() or {}
+                if meta.get("format") != VAR_SNAPSHOT_FORMAT:
+                    return None
+                tensors = {k: f.get_tensor(k) for k in f.keys()}
+            value = _unflatten(json.loads(meta["structure"]), tensors)
+            os.utime(path)
+            self._files[fn][1] = os.stat(path).st_mtime
+        except Exception:
+            self._forget(fn)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def _save_unlocked(self, key, value):
+        from safetensors.torch import save_file
+
+        self._scan()
+        try:
+            tensors = {}
+            structure = _flatten(value, tensors, {})
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(key)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            save_file(tensors, tmp, metadata={"format": VAR_SNAPSHOT_FORMAT, "structure": json.dumps(structure)})
+            os.replace(tmp, path)
+            st = os.stat(path)
+        except Exception as e:
+            log.warning("[AK] Setter snapshot not saved: %s", e)
+            return
+
+        fn = key + COND_DISK_SUFFIX
+        self._forget(fn)
+        self._files[fn] = [st.st_size, st.st_mtime]
+        self.bytes += st.st_size
+        self._evict()
+
+
+def _default_dir():
+    if VAR_SNAPSHOT_DIR:
+        return VAR_SNAPSHOT_DIR
+    import folder_paths
+
+    return os.path.join(folder_paths.get_user_directory(), "ak_var_snapshots")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_snapshot_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            try:
+                _store = VarSnapshotStore(_default_dir())
+            except Exception:
+                return None
+    return _store
+
+
+# ---------------------------------------------------------------------------
+# Prompt rewrite
+# ---------------------------------------------------------------------------
+
+def apply_snapshots(prompt):
+    """Swap snapshot Setters that have a saved value for restore nodes.
+
+    Returns {setter id: key} for the snapshot Setters that still have to run
+    (and save). Consumers of a restored Setter keep their links: the restore
+    node takes over the Setter's node id.
+    """
+    keys = {}
+    memo = {}
+    for node_id, node in prompt.items():
+        if not isinstance(node, dict) or node.get("class_type") != SETTER_CLASS:
+            continue
+        if (node.get("inputs") or {}).get("snapshot") is not True:
+            continue
+        # All keys are taken from the unmodified prompt.
+        key = snapshot_key(prompt, node_id, memo)
+        if key is not None:
+            keys[str(node_id)] = key
+    if not keys:
+        return {}
+
+    store = get_snapshot_store()
+    if store is None:
+        return {}
+    pending = {}
+    for node_id, key in keys.items():
+        if store.has(key):
+            node = prompt[node_id]
+            node["class_type"] = RESTORE_CLASS
+            node["inputs"] = {"snapshot_key": key, "var_name": (node.get("inputs") or {}).get("var_name", "")}
+        else:
+            pending[node_id] = key
+    return pending
+
+
+def save_snapshot(key, value):
+    store = get_snapshot_store()
+    if store is not None and key:
+        store.save(key, value)
+
+
+class AnyType(str):
+    def __ne__(self, __value: object) -> bool:
+        return False
+
+
+ANY_TYPE = AnyType("*")
+
+
+class SetterSnapshotRestore:
+    """Stands in for a snapshot Setter whose upstream is unchanged.
+
+    Inserted by the prompt rewrite, not meant to be added by hand.
+    """
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "snapshot_key": ("STRING", {"default": ""}),
+                "var_name": ("STRING", {"default": ""}),
+            },
+        }
+
+    RETURN_TYPES = (ANY_TYPE,)
+    RETURN_NAMES = ("OUT",)
+    FUNCTION = "restore"
+    CATEGORY = "AK/_testing_"
+
+    def restore(self, snapshot_key, var_name):
+        store = get_snapshot_store()
+        value = store.load(snapshot_key) if store is not None else None
+        if value is None:
+            raise Exception(f"[Setter snapshot {var_name}] snapshot {snapshot_key} is missing or unreadable, queue the prompt again")
+        return (value,)
+
+
+NODE_CLASS_MAPPINGS = {
+    RESTORE_CLASS: SetterSnapshotRestore,
+}
+NODE_DISPLAY_NAME_MAPPINGS = {
+    RESTORE_CLASS: "Setter Snapshot (restore)",
+}